@@ -0,0 +1,4 @@
+"""Run the benchmarks with `python -m benchmarks`"""
+from benchmarks.runner import main
+
+main()
@@ -0,0 +1,149 @@
+"""Fixtures for benchmarking django-sekh"""
+import random
+
+KB = 1024
+MB = 1024 * KB
+
+SIZES = (KB, 10 * KB, 100 * KB, MB, 5 * MB)
+
+TERM_COUNTS = (1, 10, 100)
+
+SYLLABLES = ('ba', 'ce', 'di', 'fo', 'gu', 'ha', 'je', 'ki', 'lo', 'mu',
+             'na', 'pe', 'qui', 'ro', 'su', 'ta', 've', 'xi', 'yo', 'zu')
+
+
+def get_vocabulary(size=2000, seed=42):
+    """
+    Returns a list of distinct pseudo words,
+    the first ones being the most frequent.
+    """
+    rand = random.Random(seed)
+    words = []
+    seen = set()
+    while len(words) < size:
+        word = ''.join(rand.choice(SYLLABLES)
+                       for i in range(rand.randint(1, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+VOCABULARY = get_vocabulary()
+
+WEIGHTS = [1.0 / rank for rank in range(1, len(VOCABULARY) + 1)]
+
+
+def get_terms(count):
+    """
+    Returns count terms of the vocabulary, from the
+    frequent ones to the rare ones.
+    """
+    step = max(1, len(VOCABULARY) // (count * 2))
+    return [VOCABULARY[10 + index * step] for index in range(count)]
+
+
+def generate_sentence(rand):
+    words = rand.choices(VOCABULARY, WEIGHTS, k=rand.randint(6, 20))
+    return ' '.join(words).capitalize() + '.'
+
+
+def generate_text(size, seed=0):
+    """
+    Plain text of about size characters.
+    """
+    rand = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        sentence = generate_sentence(rand)
+        parts.append(sentence)
+        length += len(sentence) + 1
+    return ' '.join(parts)[:size]
+
+
+def wrap_document(body, title='Benchmark'):
+    return ('<!DOCTYPE html>\n<html>\n<head>\n'
+            '<meta charset="utf-8" />\n<title>%s</title>\n'
+            '</head>\n<body>\n%s\n</body>\n</html>\n' % (title, body))
+
+
+def generate_synthetic(size, seed=0):
+    """
+    HTML page made only of paragraphs of text.
+    """
+    rand = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        paragraph = '<p>%s</p>\n' % ' '.join(
+            generate_sentence(rand) for i in range(rand.randint(2, 6)))
+        parts.append(paragraph)
+        length += len(paragraph)
+    return wrap_document(''.join(parts))
+
+
+def generate_realistic(size, seed=0):
+    """
+    HTML page looking like a blog, with styles, scripts,
+    navigation, attributes, entities and comments.
+    """
+    rand = random.Random(seed)
+    head = ('<style type="text/css">\n'
+            'body { font-family: sans-serif; }\n'
+            '.highlight { background: yellow; }\n'
+            '</style>\n'
+            '<script type="text/javascript">\n'
+            'var terms = ["%s"]; if (1 < 2 && terms) {}\n'
+            '</script>\n' % '", "'.join(VOCABULARY[:20]))
+    nav = '<nav><ul>%s</ul></nav>\n' % ''.join(
+        '<li class="menu-item"><a href="/%s/" title="%s">%s</a></li>' % (
+            word, word, word.capitalize()) for word in VOCABULARY[:15])
+    parts = [head, nav]
+    length = len(head) + len(nav)
+    while length < size:
+        sentence = generate_sentence(rand)
+        words = sentence.split()
+        position = rand.randrange(len(words))
+        words[position] = rand.choice((
+            '<a href="/tag/%(w)s/" rel="tag">%(w)s</a>',
+            '<strong>%(w)s</strong>', '<em class="note">%(w)s</em>',
+            '%(w)s&nbsp;&amp;', '<img src="/%(w)s.png" alt="%(w)s" />',
+            '%(w)s<!-- %(w)s -->')) % {'w': words[position]}
+        article = ('<article id="post-%d" class="post">\n'
+                   '<h2 class="title"><a href="/post/%d/">%s</a></h2>\n'
+                   '<div class="content"><p>%s</p><p>%s</p></div>\n'
+                   '</article>\n' % (
+                       length, length, generate_sentence(rand),
+                       ' '.join(words), generate_sentence(rand)))
+        parts.append(article)
+        length += len(article)
+    return wrap_document(''.join(parts))
+
+
+def generate_protected(size, seed=0):
+    """
+    HTML page where most of the text is inside protected markups.
+    """
+    rand = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        block = rand.choice((
+            '<pre><code>%s</code></pre>\n',
+            '<p><code>%s</code> %s</p>\n',
+            '<script>var text = "%s";</script>\n',
+            '<p>%s <code>%s</code></p>\n',
+            '<pre>%s\n%s</pre>\n'))
+        block = block % tuple(generate_sentence(rand)
+                              for i in range(block.count('%s')))
+        parts.append(block)
+        length += len(block)
+    return wrap_document(''.join(parts))
+
+
+DOCUMENTS = {
+    'synthetic': generate_synthetic,
+    'realistic': generate_realistic,
+    'protected': generate_protected,
+}
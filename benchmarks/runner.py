@@ -0,0 +1,166 @@
+"""Runner of the benchmarks for django-sekh"""
+import gc
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+import django
+from django.conf import settings
+
+from benchmarks.fixtures import KB
+from benchmarks.fixtures import SIZES
+from benchmarks.fixtures import DOCUMENTS
+from benchmarks.fixtures import TERM_COUNTS
+from benchmarks.fixtures import get_terms
+from benchmarks.fixtures import generate_text
+
+FUNCTIONS = ('highlight', 'excerpt', 'middleware')
+
+
+def setup_django():
+    """
+    Configure a minimal Django if no settings are provided.
+    """
+    if not settings.configured:
+        settings.configure(
+            DEBUG=False, SECRET_KEY='benchmarks',
+            ALLOWED_HOSTS=['*'], INSTALLED_APPS=['sekh'])
+    django.setup()
+
+
+def percentile(timings, percent):
+    timings = sorted(timings)
+    index = int(round(percent / 100.0 * (len(timings) - 1)))
+    return timings[index]
+
+
+def measure(function, setup, repeat):
+    """
+    Time function(*setup()) repeat times, then measure its
+    peak of memory in a last run, setup being not measured.
+    """
+    timings = []
+    for i in range(repeat):
+        args = setup()
+        gc.collect()
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+
+    args = setup()
+    gc.collect()
+    tracemalloc.start()
+    function(*args)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'p50': percentile(timings, 50),
+            'p99': percentile(timings, 99),
+            'min': min(timings),
+            'peak_memory': peak_memory}
+
+
+def get_cases(function, document, size, term_count):
+    """
+    Returns the (callable, setup, size in bytes)
+    benchmarking the function on a fixture.
+    """
+    terms = get_terms(term_count)
+
+    if function == 'highlight':
+        from sekh.highlighting import highlight
+        content = DOCUMENTS[document](size)
+        return (highlight, lambda: (content, terms),
+                len(content.encode('utf-8')))
+
+    if function == 'excerpt':
+        from sekh.excerpt import excerpt
+        content = generate_text(size)
+        return (excerpt, lambda: (content, terms),
+                len(content.encode('utf-8')))
+
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+    from sekh.middleware import KeywordsHighlightingMiddleware
+
+    content = DOCUMENTS[document](size).encode('utf-8')
+    request = RequestFactory().get('/', {'hl': ' '.join(terms)})
+    middleware = KeywordsHighlightingMiddleware()
+
+    def setup():
+        return request, HttpResponse(content)
+
+    return middleware.process_response, setup, len(content)
+
+
+def get_repeat(size, repeat):
+    """
+    Scale down the repetitions for the large fixtures.
+    """
+    return max(3, min(repeat, repeat * 100 * KB // size))
+
+
+def run(functions=FUNCTIONS, documents=sorted(DOCUMENTS),
+        sizes=SIZES, term_counts=TERM_COUNTS, repeat=20,
+        stream=sys.stderr):
+    """
+    Run the benchmarks and returns their results.
+    """
+    results = []
+    for function in functions:
+        # The excerpts are computed on plain text only
+        for document in (function == 'excerpt' and ['text'] or documents):
+            for size in sizes:
+                for term_count in term_counts:
+                    callable, setup, size_bytes = get_cases(
+                        function, document, size, term_count)
+                    result = measure(callable, setup,
+                                     get_repeat(size, repeat))
+                    result.update({
+                        'function': function, 'document': document,
+                        'size': size_bytes, 'terms': term_count,
+                        'throughput': size_bytes / result['p50'] / 1024 ** 2})
+                    results.append(result)
+                    stream.write(
+                        '%(function)-10s %(document)-9s %(size)9d B '
+                        '%(terms)3d terms %(throughput)8.2f MB/s '
+                        'p50 %(p50)9.5fs p99 %(p99)9.5fs '
+                        'peak %(peak_memory)10d B\n' % result)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of django-sekh.')
+    parser.add_argument('--function', action='append', choices=FUNCTIONS,
+                        help='Function to benchmark, all by default.')
+    parser.add_argument('--document', action='append',
+                        choices=sorted(DOCUMENTS),
+                        help='Kind of HTML fixture, all by default.')
+    parser.add_argument('--size', action='append', type=int,
+                        help='Size in bytes of the fixtures.')
+    parser.add_argument('--terms', action='append', type=int,
+                        help='Number of searched terms.')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Number of runs on the 100 KB fixtures, '
+                        'scaled on the size.')
+    parser.add_argument('--output', help='Write the results in JSON there.')
+    options = parser.parse_args(argv)
+
+    setup_django()
+    results = run(options.function or FUNCTIONS,
+                  options.document or sorted(DOCUMENTS),
+                  options.size or SIZES,
+                  options.terms or TERM_COUNTS,
+                  options.repeat)
+
+    report = {'python': platform.python_version(),
+              'django': django.get_version(),
+              'results': results}
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    return report
@@ -0,0 +1,19 @@
+"""Decorators for django-sekh"""
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+
+
+def no_highlight(view_func):
+    """
+    Mark a view as never highlighted by the middleware.
+    """
+    if iscoroutinefunction(view_func):
+        async def wrapped_view(*args, **kwargs):
+            return await view_func(*args, **kwargs)
+    else:
+        def wrapped_view(*args, **kwargs):
+            return view_func(*args, **kwargs)
+
+    wrapped_view.no_highlight = True
+    return wraps(view_func)(wrapped_view)
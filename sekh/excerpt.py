@@ -1,29 +1,80 @@
 """Excerpt for django-sekh"""
-from sekh.utils import list_range
-from sekh.utils import get_window
-from sekh.utils import get_min_index
-from sekh.utils import compile_terms
+import re
+import heapq
+from time import monotonic
+from array import array
+from itertools import islice
+from itertools import repeat
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sekh.utils import get_pattern
+from sekh.utils import remove_duplicates
+from sekh.metrics import record
+from sekh.highlighting import highlight_fragment
 from sekh.settings import EXCERPT_MAX_LENGTH
 from sekh.settings import EXCERPT_MATCH_WINDOW_SIZE
+from sekh.settings import EXCERPT_NUMPY_THRESHOLD
+
+SPACE_RE = re.compile(r'\s', re.U)
+
+WORDS_BLOCK_SIZE = 65536
 
+# Number of distinct words whose match is remembered,
+# bounding the memory used by the matches dictionnaries
+MATCHES_SIZE = 16384
 
-def generate_term_positions(splitted_content, terms):
+
+def iter_words(content):
     """
-    Iterates over the words in the corpus and stores the locations of
-    each matched query term. This data is structured as a list of lists,
-    where each sub-list contains all of the positions for a matched query
-    term.
+    Yields the words of the content as str.split would, block
+    by block, without building the list of all the words.
     """
-    positions = [[] for i in range(len(terms))]
-    terms = compile_terms(sorted(terms))
+    position = 0
+    while position < len(content):
+        space = SPACE_RE.search(content, position + WORDS_BLOCK_SIZE)
+        end = space.start() if space else len(content)
+        for word in content[position:end].split():
+            yield word
+        position = end
 
-    for i, word in enumerate(splitted_content):
-        for term in terms:
-            if term.match(word):
-                positions[terms.index(term)].append(i)
-                break
 
-    return [x for x in positions if x]
+def get_word_matcher(terms, matches=None):
+    """
+    Returns a function giving the index of the query term starting
+    a word, or None. Each distinct word is matched only once, the
+    matches of the first MATCHES_SIZE distinct words being stored
+    in the matches dictionnary if provided, which can be shared by
+    the corpuses searched with the same terms.
+    """
+    match = get_pattern(terms).match
+    if matches is None:
+        matches = {}
+
+    def match_word(word):
+        term_index = matches.get(word, False)
+        if term_index is False:
+            term_index = match(word)
+            if len(matches) < MATCHES_SIZE:
+                matches[word] = term_index
+        return term_index
+
+    return match_word
+
+
+def generate_term_positions(splitted_content, terms, matches=None):
+    """
+    Iterates over the words in the corpus and stores the locations of
+    each matched query term. This data is structured as a list of arrays,
+    where each array contains all of the positions for a matched query
+    term, in the order of the terms.
+    """
+    word_count, word_positions, term_ids = locate_terms(
+        splitted_content, remove_duplicates(terms), matches)
+    return group_term_positions(word_positions, term_ids)
 
 
 def shortest_term_span(positions):
@@ -31,51 +82,77 @@ def shortest_term_span(positions):
     Given a list of positions in a corpus, returns
     the shortest span of words that contain all query terms.
     """
-    # Initialize our list of lists where each list corresponds
-    # to the locations within the document for a term
+    # Our window holds the current position of each term, the
+    # positions of a term being exhausted when its last is reached
     indices = [0] * len(positions)
-    min_window = window = get_window(positions, indices)
+    window = [term_positions[0] for term_positions in positions]
+    min_window = list(window)
+    high = max(window)
+    min_range = high - min(window)
 
-    # Iteratively moving the minimum index forward finds us our
-    # minimum span
-    while True:
-        min_index = get_min_index(positions, window)
+    heap = []
+    exhausted_low = None
+    for index, position in enumerate(window):
+        if position < positions[index][-1]:
+            heap.append((position, index))
+        elif exhausted_low is None or position < exhausted_low:
+            exhausted_low = position
+    heapq.heapify(heap)
 
-        if min_index is None:
-            break
+    # Iteratively moving the minimum index forward finds us our
+    # minimum span, the exhausted terms being never moved
+    while heap:
+        position, index = heapq.heappop(heap)
+        indices[index] += 1
+        position = window[index] = positions[index][indices[index]]
+        high = max(high, position)
 
-        indices[min_index] += 1
+        if position < positions[index][-1]:
+            heapq.heappush(heap, (position, index))
+        elif exhausted_low is None or position < exhausted_low:
+            exhausted_low = position
 
-        window = get_window(positions, indices)
+        low = exhausted_low
+        if heap and (low is None or heap[0][0] < low):
+            low = heap[0][0]
 
-        if list_range(min_window) > list_range(window):
-            min_window = window
+        if min_range > high - low:
+            min_window = list(window)
+            min_range = high - low
 
-        if list_range(min_window) == len(positions):
+        if min_range == len(positions):
             break
 
     return sorted(min_window)
 
 
-def shorten_excerpt(content, terms):
+def shorten_excerpt(content, terms, matches=None):
     """
     Iterates over the words in the excerpt and attempts to
     "close the gap" between matched terms in an overly long excerpt.
+    """
+    return shorten_words(iter_words(content), terms, matches)
+
+
+def shorten_words(words, terms, matches=None):
+    """
+    Joins the words of an overly long excerpt,
+    the words far from the matched terms being skipped.
     Naive implementation.
     """
     flattened_excerpt_words = []
     last_term_appearence = 0
     skipping_words = False
-    terms = compile_terms(terms)
+    match_word = get_word_matcher(terms, matches)
 
-    for i, word in enumerate(content.split()):
+    for i, word in enumerate(words):
+        term_index = match_word(word)
 
         # Spotted a matched term, set our state flag to false and update
         # the "time" of our last term appearance
-        for term in terms:
-            if term.match(word):
-                last_term_appearence = i
-                skipping_words = False
+        if term_index is not None:
+            last_term_appearence = i
+            skipping_words = False
 
         # If it's been too long since our last match, start dropping words
         if i - last_term_appearence > EXCERPT_MATCH_WINDOW_SIZE:
@@ -93,25 +170,179 @@ def shorten_excerpt(content, terms):
     return ' '.join(flattened_excerpt_words)
 
 
-def excerpt(content, terms, max_length=EXCERPT_MAX_LENGTH):
+def locate_terms(words, terms, matches=None):
     """
-    Make a excerpt centered on the terms.
+    Scans the words, returns their number, the positions of
+    the words starting by a query term and the index of their
+    terms, as arrays, the memory used being proportional
+    to the number of matches.
     """
-    splitted_content = content.split()
-    positions = generate_term_positions(splitted_content, terms)
+    match_word = get_word_matcher(terms, matches)
+    word_positions = array('I')
+    term_ids = array('I')
+
+    word_count = 0
+    for word_count, word in enumerate(words, 1):
+        term_index = match_word(word)
+        if term_index is not None:
+            word_positions.append(word_count - 1)
+            term_ids.append(term_index)
 
-    if not positions:
-        return ' '.join(splitted_content[:max_length]).strip()
+    return word_count, word_positions, term_ids
 
-    span = shortest_term_span(positions)
 
-    half_max_length = int(max_length / 2)
-    start = max(0, span[0] - half_max_length)
-    end = min(len(splitted_content), span[-1] + half_max_length)
+def group_term_positions(word_positions, term_ids):
+    """
+    Groups the positions of the matched words by term,
+    in the order of the terms, the terms without match
+    being left out.
+    """
+    positions = {}
+    for word_index, term_index in zip(word_positions, term_ids):
+        term_positions = positions.get(term_index)
+        if term_positions is None:
+            term_positions = positions[term_index] = array('I')
+        term_positions.append(word_index)
+    return [positions[term_index] for term_index in sorted(positions)]
 
-    excerpt = ' '.join(splitted_content[start:end + 1])
 
-    if (end - start > max_length):
-        excerpt = shorten_excerpt(excerpt, terms)
+def numpy_term_span(word_positions, term_ids):
+    """
+    Vectorised shortest_term_span, on the positions of
+    all the terms merged in a single ordered array.
 
+    Moving the minimum index forward moves the windows over the
+    merged positions in order, except the last position of each
+    term which never moves, so the window after moving the position
+    j has for each term its first position after j, or its last.
+    """
+    word_positions = word_positions.astype(numpy.int64)
+    terms, first_indices = numpy.unique(term_ids, return_index=True)
+    last_indices = len(term_ids) - 1 - numpy.unique(
+        term_ids[::-1], return_index=True)[1]
+    moving = numpy.ones(len(word_positions), dtype=bool)
+    moving[last_indices] = False
+    moved = word_positions[moving]
+
+    term_positions = [word_positions[term_ids == term] for term in terms]
+    first_window = word_positions[first_indices]
+    highs = numpy.full(len(moved), -1, dtype=numpy.int64)
+    lows = numpy.full(len(moved), len(word_positions) and
+                      word_positions[-1] + 1, dtype=numpy.int64)
+    for positions in term_positions:
+        indices = numpy.minimum(numpy.searchsorted(
+            positions, moved, side='right'), len(positions) - 1)
+        numpy.maximum(highs, positions[indices], out=highs)
+        numpy.minimum(lows, positions[indices], out=lows)
+
+    ranges = numpy.concatenate((
+        [first_window.max() - first_window.min()], highs - lows))
+    # The search stops once the shortest range equals the number
+    # of terms, and keeps the first window of the shortest range
+    stops = numpy.flatnonzero(
+        numpy.minimum.accumulate(ranges)[1:] == len(terms))
+    stop = stops[0] + 1 if len(stops) else len(ranges) - 1
+    step = int(numpy.argmin(ranges[:stop + 1]))
+
+    if not step:
+        return sorted(int(position) for position in first_window)
+    return sorted(int(positions[min(numpy.searchsorted(
+        positions, moved[step - 1], side='right'), len(positions) - 1)])
+        for positions in term_positions)
+
+
+def numpy_shorten_excerpt(splitted_excerpt, word_term_ids):
+    """
+    Vectorised shorten_excerpt, on the words of the excerpt
+    and the index of their term, or -1.
+    """
+    indices = numpy.arange(len(splitted_excerpt))
+    last_term_appearences = numpy.maximum.accumulate(
+        numpy.where(word_term_ids >= 0, indices, 0))
+    skipped = indices - last_term_appearences > EXCERPT_MATCH_WINDOW_SIZE
+    ellipsis = skipped & ~numpy.concatenate(([False], skipped[:-1]))
+
+    return ' '.join(
+        ellipsis[i] and '...' or splitted_excerpt[i]
+        for i in numpy.flatnonzero(~skipped | ellipsis))
+
+
+def excerpt(content, terms, max_length=EXCERPT_MAX_LENGTH, matches=None):
+    """
+    Make a excerpt centered on the terms, the words of the content
+    being scanned twice rather than splitted, and the span and the
+    shortening vectorised for the long contents if NumPy is installed.
+    """
+    begin = monotonic()
+    if matches is None:
+        matches = {}
+    word_count, word_positions, term_ids = locate_terms(
+        iter_words(content), terms, matches)
+    vectorised = (numpy is not None and
+                  EXCERPT_NUMPY_THRESHOLD is not None and
+                  word_count >= EXCERPT_NUMPY_THRESHOLD)
+
+    if not word_positions:
+        span = None
+    elif vectorised:
+        word_positions = numpy.frombuffer(word_positions, dtype=numpy.uint32)
+        term_ids = numpy.frombuffer(term_ids, dtype=numpy.uint32)
+        span = numpy_term_span(word_positions, term_ids)
+    else:
+        span = shortest_term_span(
+            group_term_positions(word_positions, term_ids))
+
+    if not span:
+        excerpt = ' '.join(islice(iter_words(content), max_length))
+    else:
+        half_max_length = int(max_length / 2)
+        start = max(0, span[0] - half_max_length)
+        end = min(word_count, span[-1] + half_max_length)
+
+        words = islice(iter_words(content), start, end + 1)
+        if (end - start > max_length) and vectorised:
+            # The term of each word of the excerpt, or -1
+            words = list(words)
+            window = slice(*numpy.searchsorted(
+                word_positions, [start, start + len(words)]))
+            word_term_ids = numpy.full(len(words), -1, dtype=numpy.int64)
+            word_term_ids[word_positions[window] - start] = term_ids[window]
+            excerpt = numpy_shorten_excerpt(words, word_term_ids)
+        elif (end - start > max_length):
+            excerpt = shorten_words(words, terms, matches)
+        else:
+            excerpt = ' '.join(words)
+
+    record('excerpt', monotonic() - begin, size=len(content),
+           terms=len(terms), matches=len(word_positions),
+           outcome=span and 'excerpted' or 'no-match')
     return excerpt
+
+
+def excerpt_highlight(content, terms, max_length=EXCERPT_MAX_LENGTH,
+                      matches=None):
+    """
+    Make a excerpt centered on the terms, escaped and with the terms
+    wrapped by the highlighting pattern, as highlighting the escaped
+    excerpt would, but without parsing it as HTML.
+    """
+    return highlight_fragment(
+        excerpt(content, terms, max_length, matches), terms)
+
+
+def excerpt_many(documents, terms, max_length=EXCERPT_MAX_LENGTH,
+                 executor=None):
+    """
+    Make the excerpts of an iterable of documents centered on the
+    same terms, yielded in order as they are made. The words are
+    matched once for all the documents, the matches of the first
+    MATCHES_SIZE distinct words being shared, or the documents are
+    spread over the pool of the executor if provided.
+    """
+    terms = remove_duplicates(terms)
+    if executor is not None:
+        return executor.map(excerpt, documents,
+                            repeat(terms), repeat(max_length))
+    matches = {}
+    return (excerpt(document, terms, max_length, matches)
+            for document in documents)
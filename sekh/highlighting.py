@@ -1,37 +1,922 @@
 """Highlighting for django-sekh"""
-from bs4 import BeautifulSoup
+import os
+import multiprocessing
+import re
+import zlib
+import codecs
+import asyncio
+from time import monotonic
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from html import escape
+from html.parser import HTMLParser
 
-from sekh.utils import compile_terms
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from sekh.utils import get_pattern
+from sekh.utils import get_prefilter
+from sekh.metrics import record
+from sekh.settings import PARSER
+from sekh.settings import EXECUTOR
+from sekh.settings import EXECUTOR_WORKERS
+from sekh.settings import OFFLOAD_SIZE
+from sekh.settings import OFFLOAD_TIMEOUT
 from sekh.settings import PROTECTED_MARKUPS
 from sekh.settings import HIGHLIGHTING_PATTERN
 
+MARKUP_RE = re.compile(r"""
+    <!--.*?-->                                       # Comment
+  | <!\[CDATA\[.*?\]\]>                              # CDATA section
+  | <!(?!--|\[CDATA\[)[^>]*>                         # Doctype
+  | <\?[^>]*>                                        # Processing instruction
+  | </?(?P<tag>[a-zA-Z][^\s/>'"]*)(?:[^'">]|"[^"]*"|'[^']*')*>  # Tag
+  | &\#?\w+;                                         # Character reference
+  """, re.S | re.X)
+
+PENDING_MARKUP_RE = re.compile(r"""
+    <(?:[a-zA-Z!?/]|\Z)                              # Markup
+  | &\#?\w*\Z                                        # Character reference
+  """, re.X)
+
+DOCUMENT_RE = re.compile(r'<(?:!doctype|html)[\s>]', re.I)
+
+DOCTYPE_RE = re.compile(r'<!doctype[\s>]', re.I)
+
+SURROGATE_RE = re.compile('[\udc80-\udcff]')
+
+RAW_TEXT_MARKUPS = {
+    'script': re.compile(r'</script\s*>', re.I),
+    'style': re.compile(r'</style\s*>', re.I),
+}
+
+
+WATCHED_MARKUPS = set(PROTECTED_MARKUPS) | set(RAW_TEXT_MARKUPS)
+
+SKIP_RE = re.compile(r"""(?:
+    [^<&]+                                           # Text
+  | <!--.*?-->                                       # Comment
+  | <!\[CDATA\[.*?\]\]>                              # CDATA section
+  | <!(?!--|\[CDATA\[)[^>]*>                         # Doctype
+  | <\?[^>]*>                                        # Processing instruction
+  | </?(?!(?:%s)[\s/>'"])[a-zA-Z][^\s/>'"]*(?:[^'">]|"[^"]*"|'[^']*')*>  # Tag
+  | &\#?\w+;                                         # Character reference
+  | <(?=[^a-zA-Z!?/])                                # Lower than sign
+  | &\#?(?=[^\#\w])                                  # Ampersand
+  )*""" % '|'.join(''.join('[%s%s]' % (char.lower(), char.upper())
+                           for char in name)
+                   for name in WATCHED_MARKUPS), re.S | re.X)
+
+SKIP_WINDOW = 65536
 
-def highlight(content, terms):
+# Size of the blocks of the compressed contents decompressed at once
+DECOMPRESS_SIZE = 65536
+
+
+class HighlightTimeout(Exception):
+    """
+    Raised by the backends when the time budget
+    of the highlighting is exhausted.
     """
-    Highlight the HTML with BeautifulSoup.
+
+
+class BaseHighlighter(object):
     """
-    index = 1
-    update_content = False
-    soup = BeautifulSoup(content)
-    terms = compile_terms(terms)
+    Base class of the highlighting backends, matching
+    all the terms together in the text nodes which are
+    not inside a protected markup.
+
+    The backends implement highlight(), which must return
+    the content itself if nothing has been highlighted, and
+    stop highlighting once expired() is true, returning the
+    content partially highlighted if still well-formed,
+    or untouched.
+    """
+    highlighting_pattern = HIGHLIGHTING_PATTERN
+
+    def __init__(self, terms, budget=None):
+        self.pattern = get_pattern(terms)
+        self.max_length = max(self.pattern.max_length, 1)
+        self.protected = []
+        self.updated = False
+        self.degraded = False
+        self.matches = 0
+        self.deadline = None
+        if budget is not None:
+            self.deadline = monotonic() + budget
+
+    def expired(self):
+        """
+        Tells if the time budget is exhausted,
+        the highlighting being then degraded.
+        """
+        if self.deadline is not None and monotonic() > self.deadline:
+            self.degraded = True
+        return self.degraded
+
+    def highlight_text(self, text, final=True):
+        """
+        Wrap the terms found in a text node with the highlighting
+        pattern, returning the highlighted text and the length
+        of the text processed, the remaining text being possibly
+        the beginning of a term if the text node is not final.
+        """
+        pieces = []
+        position = 0
+        limit = len(text)
+        if not final:
+            limit = max(0, limit - self.max_length + 1)
+
+        for start, end, index in self.pattern.finditer(text):
+            if end > limit:
+                if start < limit:
+                    limit = start
+                break
+            self.matches += 1
+            pieces.append(text[position:start])
+            pieces.append(self.highlighting_pattern % {
+                'index': index + 1, 'term': text[start:end]})
+            position = end
 
-    for term in terms:
-        for text in soup.find_all(text=term):
-            if text.parent.name in PROTECTED_MARKUPS:
-                continue
+        if not pieces:
+            return text[:limit], limit
+        self.updated = True
+        pieces.append(text[position:limit])
+        return ''.join(pieces), limit
+
+    def handle_tag(self, name, markup):
+        """
+        Keep track of the opened protected markups.
+        """
+        name = name.lower()
+        if name not in PROTECTED_MARKUPS:
+            return
+        if markup[1] != '/':
+            if not markup.endswith('/>'):
+                self.protected.append(name)
+        elif name in self.protected:
+            index = len(self.protected) - \
+                self.protected[::-1].index(name) - 1
+            del self.protected[index:]
+
+    def highlight(self, content):
+        """
+        Highlight the whole content at once.
+        """
+        raise NotImplementedError
+
+
+class Highlighter(BaseHighlighter):
+    """
+    Highlight terms in HTML by tokenizing the markup once
+    with regular expressions, without building any tree.
+
+    The HTML can be highlighted at once, or incrementally
+    with feed() and close(), the incomplete tokens and the
+    protected markups being carried over the chunks.
+    """
+
+    def __init__(self, terms, budget=None):
+        super(Highlighter, self).__init__(terms, budget)
+        self.raw_text = None
+        self.buffer = ''
+
+    def process(self, final):
+        """
+        Highlight the buffered content and serialize it in one pass,
+        keeping in the buffer what can not be decided yet if the
+        content is not final.
+        """
+        content = self.buffer
+        if self.degraded:
+            self.buffer = ''
+            return content
+
+        output = []
+        position = flushed = 0
+        length = len(content)
+        hit = -1
+
+        while position < length:
+            if self.raw_text is not None:
+                closing = self.raw_text.search(content, position)
+                if closing:
+                    position = closing.start()
+                    self.raw_text = None
+                    continue
+                # Keep the last markup which can begin the closing one,
+                # within SKIP_WINDOW
+                end = -1 if final else content.rfind(
+                    '<', max(position, length - SKIP_WINDOW))
+                position = length if end == -1 else end
+                break
+
+            # Skip the text and the markups which can not contain
+            # a term to highlight nor change the protected state,
+            # the next term being found by searching the whole content.
+            if not self.protected and hit < position:
+                hit = self.pattern.search(content, position)
+                hit = length if hit == -1 else hit
+            limit = length if self.protected else hit
+            if not final:
+                limit = min(limit, length - self.max_length + 1)
+            limit = min(limit, position + SKIP_WINDOW)
+            if limit > position:
+                position = SKIP_RE.match(content, position, limit).end()
+                if position == length:
+                    break
+
+            match = MARKUP_RE.search(content, position)
+            end = match.start() if match else length
+            if not final:
+                # The markups pending for more than SKIP_WINDOW are
+                # never closed, like an unclosed comment, and are
+                # taken as text as when the content is final
+                pending = PENDING_MARKUP_RE.search(
+                    content, max(position, length - SKIP_WINDOW),
+                    min(end + 1, length))
+                end = pending.start() if pending else end
+            if end > position and not self.protected:
+                complete = final or (match is not None and
+                                     end == match.start())
+                if hit < position:
+                    hit = self.pattern.search(content, position)
+                    hit = length if hit == -1 else hit
+                if (hit < end or not complete) and self.expired():
+                    # Leave the rest of the content as it is
+                    position = length
+                    break
+                if hit < end or not complete:
+                    output.append(content[flushed:position])
+                    text, processed = self.highlight_text(
+                        content[position:end], complete)
+                    output.append(text)
+                    end = flushed = position + processed
+            position = end
+            if match is None or position < match.start():
+                break
+
+            position = match.end()
+            name = match.group('tag')
+            if name and name.lower() in WATCHED_MARKUPS:
+                markup = match.group(0)
+                self.handle_tag(name, markup)
+                if markup[1] != '/':
+                    self.raw_text = RAW_TEXT_MARKUPS.get(name.lower())
+
+        output.append(content[flushed:position])
+        self.buffer = content[position:]
+        return ''.join(output)
+
+    def feed(self, data):
+        """
+        Highlight a chunk of HTML, returning the highlighted
+        output which can be sent.
+        """
+        self.buffer += data
+        return self.process(False)
+
+    def close(self):
+        """
+        Highlight what remains of the HTML.
+        """
+        return self.process(True)
+
+    def highlight(self, content):
+        """
+        Highlight the whole content at once.
+        """
+        self.buffer = content
+        output = self.process(True)
+        if self.updated:
+            return output
+        return content
+
+
+class HTMLParserHighlighter(BaseHighlighter, HTMLParser):
+    """
+    Highlight terms in HTML by tokenizing the markup once
+    with the HTMLParser of the standard library,
+    without building any tree.
+    """
 
-            def highlight(match):
-                match_term = match.group(0)
-                return HIGHLIGHTING_PATTERN % {
-                    'index': index, 'term': match_term}
+    def __init__(self, terms, budget=None):
+        BaseHighlighter.__init__(self, terms, budget)
+        HTMLParser.__init__(self, convert_charrefs=False)
+        self.raw_text = None
+        self.content = ''
+        self.position = 0
+        self.line = 1
+        self.line_start = 0
+        self.output = []
 
-            new_text = term.sub(highlight, text)
-            text.replace_with(BeautifulSoup(new_text))
-            update_content = True
-        # Reload the entire soup, because substituion
-        # doesn't rebuild the document tree
-        soup = BeautifulSoup(str(soup))
-        index += 1
-    if update_content:
-        return str(soup)
-    return content
+    def get_offset(self):
+        """
+        Offset in the content of the token being parsed,
+        worked out from getpos() as the tokens come in order.
+        """
+        line, column = self.getpos()
+        while self.line < line:
+            self.line_start = self.content.index('\n', self.line_start) + 1
+            self.line += 1
+        return self.line_start + column
+
+    def handle_starttag(self, tag, attrs):
+        markup = self.get_starttag_text()
+        self.handle_tag(tag, markup)
+        if tag in RAW_TEXT_MARKUPS and not markup.endswith('/>'):
+            self.raw_text = tag
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_tag(tag, self.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        self.handle_tag(tag, '</%s>' % tag)
+        if tag == self.raw_text:
+            self.raw_text = None
+
+    def handle_data(self, data):
+        """
+        Replace the text by its highlighting in the output, the
+        content between the texts being copied as it is.
+        """
+        if not self.protected and self.raw_text is None:
+            if self.expired():
+                raise HighlightTimeout
+            start = self.get_offset()
+            if not self.content.startswith(data, start):
+                return
+            matches = self.matches
+            text = self.highlight_text(data)[0]
+            if self.matches > matches:
+                self.output.append(self.content[self.position:start])
+                self.output.append(text)
+                self.position = start + len(data)
+
+    def highlight(self, content):
+        """
+        Highlight the whole content at once.
+        """
+        self.content = content
+        try:
+            self.feed(content)
+            self.close()
+        except HighlightTimeout:
+            return content
+        if self.updated:
+            self.output.append(content[self.position:])
+            return ''.join(self.output)
+        return content
+
+
+class LxmlHighlighter(BaseHighlighter):
+    """
+    Highlight terms in HTML parsed with lxml, the matches
+    being marked in the tree then replaced by the highlighting
+    pattern once the tree is serialized.
+    """
+    highlighting_pattern = '\ue000%(index)s\ue001%(term)s\ue002'
+    marker_re = re.compile('\ue000(\\d+)\ue001(.*?)\ue002', re.S)
+
+    def highlight_element(self, element, protected=False):
+        """
+        Mark the terms in the texts of an element and its children.
+        """
+        if not isinstance(element.tag, str):  # Comment or PI
+            return
+        name = element.tag.lower()
+        protected = (protected or name in PROTECTED_MARKUPS or
+                     name in RAW_TEXT_MARKUPS)
+        if self.expired():
+            raise HighlightTimeout
+        if element.text and not protected:
+            element.text = self.highlight_text(element.text)[0]
+        for child in element:
+            self.highlight_element(child, protected)
+            if child.tail and not protected:
+                child.tail = self.highlight_text(child.tail)[0]
+
+    def highlight(self, content):
+        """
+        Highlight the whole content at once.
+        """
+        if not content.strip() or SURROGATE_RE.search(content):
+            # lxml truncates the texts at the undecodable bytes
+            return content
+
+        try:
+            output = self.highlight_tree(content)
+        except HighlightTimeout:
+            return content
+
+        if not self.updated:
+            return content
+        return self.marker_re.sub(self.replace_marker, output)
+
+    def highlight_tree(self, content):
+        """
+        Parse the content, mark the terms in the tree
+        and serialize it.
+        """
+        if DOCUMENT_RE.search(content):
+            root = lxml.html.document_fromstring(content)
+            self.highlight_element(root)
+            if DOCTYPE_RE.search(content):
+                root = root.getroottree()
+            return lxml.html.tostring(root, encoding='unicode')
+
+        fragments = lxml.html.fragments_fromstring(content)
+        if not fragments:
+            return content
+        if isinstance(fragments[0], str):
+            output = [escape(self.highlight_text(
+                fragments.pop(0))[0], False)]
+        else:
+            output = [content[:len(content) - len(content.lstrip())]]
+        for fragment in fragments:
+            self.highlight_element(fragment)
+            if fragment.tail:
+                fragment.tail = self.highlight_text(fragment.tail)[0]
+            output.append(lxml.html.tostring(
+                fragment, encoding='unicode'))
+        return ''.join(output)
+
+    def replace_marker(self, match):
+        return HIGHLIGHTING_PATTERN % {
+            'index': match.group(1), 'term': match.group(2)}
+
+
+BACKENDS = {
+    'regex': Highlighter,
+    'html.parser': HTMLParserHighlighter,
+    'lxml': LxmlHighlighter,
+}
+
+
+def get_highlighter(parser=None):
+    """
+    Returns the highlighting backend named by parser,
+    which can be the dotted path of a BaseHighlighter.
+    """
+    parser = parser or PARSER
+    backend = BACKENDS.get(parser)
+    if backend is None:
+        backend = BACKENDS[parser] = import_string(parser)
+    if backend is LxmlHighlighter and lxml is None:
+        raise ImproperlyConfigured('lxml is required by the lxml parser')
+    return backend
+
+
+def highlight(content, terms, budget=None):
+    """
+    Highlight the terms in the HTML content,
+    within budget seconds if provided.
+    """
+    return highlight_in_time(content, terms, budget)[0]
+
+
+def highlight_in_time(content, terms, budget=None):
+    """
+    Highlight the terms in the HTML content within budget seconds,
+    returning the highlighted content and if the highlighting has
+    been degraded, the content being then partially highlighted
+    or untouched.
+    """
+    start = monotonic()
+    if not terms or not get_prefilter(terms).search(content):
+        record('highlight', monotonic() - start, size=len(content),
+               terms=len(terms), matches=0, added=0, outcome='no-match')
+        return content, False
+
+    highlighter = get_highlighter()(terms, budget)
+    output = highlighter.highlight(content)
+    outcome = 'highlighted' if output is not content else 'unchanged'
+    record('highlight', monotonic() - start, size=len(content),
+           terms=len(terms), matches=highlighter.matches,
+           added=len(output) - len(content),
+           outcome='degraded' if highlighter.degraded else outcome)
+    return output, highlighter.degraded
+
+
+def highlight_fragment(text, terms, autoescape=True):
+    """
+    Highlight the terms in a text without markup, escaped if
+    autoescape, the terms being matched before escaping.
+    """
+    start = monotonic()
+    esc = autoescape and escape or (lambda x: x)
+    pieces = []
+    position = 0
+    for match_start, match_end, index in get_pattern(terms).finditer(text):
+        pieces.append(esc(text[position:match_start]))
+        pieces.append(HIGHLIGHTING_PATTERN % {
+            'index': index + 1, 'term': esc(text[match_start:match_end])})
+        position = match_end
+    pieces.append(esc(text[position:]))
+    output = ''.join(pieces)
+
+    matches = len(pieces) // 2
+    record('highlight', monotonic() - start, size=len(text),
+           terms=len(terms), matches=matches,
+           added=len(output) - len(text),
+           outcome=matches and 'highlighted' or 'no-match')
+    return output
+
+
+def highlight_content(content, terms, charset, budget=None,
+                      highlighter=None):
+    """
+    Highlight the terms in the HTML content encoded with charset,
+    returning the highlighted content, empty if nothing has been
+    highlighted, and if the highlighting has been degraded.
+    The contents larger than HIGHLIGHT_OFFLOAD_SIZE are highlighted
+    in the pool of processes, and are left untouched if they
+    are not highlighted within HIGHLIGHT_OFFLOAD_TIMEOUT, the
+    pool being then replaced if the worker is still busy.
+    The content is highlighted by the function highlighter,
+    highlight_bytes by default.
+    """
+    highlighter = highlighter or highlight_bytes
+    if worker or OFFLOAD_SIZE is None or len(content) <= OFFLOAD_SIZE:
+        return highlighter(content, terms, charset, budget)
+
+    pool = get_process_pool()
+    try:
+        future = pool.submit(highlighter, content, terms, charset, budget)
+        return future.result(OFFLOAD_TIMEOUT)
+    except TimeoutError:
+        if not future.cancel():
+            reset_process_pool(pool, terminate=True)
+    except BrokenProcessPool:
+        reset_process_pool(pool)
+    return b'', True
+
+
+def highlight_bytes(content, terms, charset, budget=None):
+    """
+    Highlight the terms in the HTML content encoded with charset,
+    in the current process, the bytes not matching the charset
+    being kept as they are.
+    """
+    text = content.decode(charset, 'surrogateescape')
+    highlighted_text, degraded = highlight_in_time(text, terms, budget)
+    if highlighted_text is text:
+        return b'', degraded
+    return highlighted_text.encode(charset, 'surrogateescape'), degraded
+
+
+class BrotliDecompressor(object):
+    """
+    Brotli decompressor with the interface of zlib.
+    """
+    unconsumed_tail = b''
+
+    def __init__(self):
+        self.decompressor = brotli.Decompressor()
+
+    def decompress(self, data, max_length=0):
+        # The input is buffered by the decompressor, and the output
+        # stops growing once max_length is reached, the rest being
+        # returned by the next calls with an empty input
+        if max_length:
+            return self.decompressor.process(
+                data, output_buffer_limit=max_length)
+        return self.decompressor.process(data)
+
+    def flush(self):
+        return b''
+
+
+class BrotliCompressor(object):
+    """
+    Brotli compressor with the interface of zlib.
+    """
+
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=5)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self, mode=zlib.Z_FINISH):
+        if mode == zlib.Z_FINISH:
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+
+CONTENT_CODINGS = {
+    'gzip': (lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+             lambda: zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)),
+    'deflate': (zlib.decompressobj, zlib.compressobj),
+}
+CONTENT_CODINGS['x-gzip'] = CONTENT_CODINGS['gzip']
+CODING_ERRORS = (zlib.error,)
+if brotli is not None:
+    CONTENT_CODINGS['br'] = (BrotliDecompressor, BrotliCompressor)
+    CODING_ERRORS += (brotli.error,)
+
+
+class ContentTooLarge(Exception):
+    """
+    Raised when a compressed content is larger
+    than its maximum size once decompressed.
+    """
+
+
+def iter_decompressed(decompressor, chunk):
+    """
+    Yields the blocks decompressed from a compressed chunk,
+    of about DECOMPRESS_SIZE bytes at most.
+    """
+    while True:
+        data = decompressor.decompress(chunk, DECOMPRESS_SIZE)
+        yield data
+        chunk = decompressor.unconsumed_tail
+        if not chunk and len(data) < DECOMPRESS_SIZE:
+            break
+
+
+def iter_decompressed_content(content, content_encoding):
+    """
+    Yields the blocks of the content decompressed
+    with the content coding.
+    """
+    decompressor = CONTENT_CODINGS[content_encoding][0]()
+    for position in range(0, len(content), DECOMPRESS_SIZE):
+        for data in iter_decompressed(
+                decompressor, content[position:position + DECOMPRESS_SIZE]):
+            yield data
+    yield decompressor.flush()
+
+
+def get_stream_functions(highlighter, encoding=None, content_encoding=None):
+    """
+    Returns the feed and close functions of the highlighter,
+    decoding and encoding the chunks with the encoding if
+    provided, and decompressing and compressing them again
+    with the content coding if provided, block by block.
+    """
+    if not encoding:
+        return highlighter.feed, highlighter.close
+
+    decoder = codecs.getincrementaldecoder(encoding)('surrogateescape')
+    encoder = codecs.getincrementalencoder(encoding)('surrogateescape')
+
+    def feed(chunk):
+        return encoder.encode(highlighter.feed(decoder.decode(chunk)))
+
+    def close():
+        output = highlighter.feed(decoder.decode(b'', True))
+        return encoder.encode(output + highlighter.close(), True)
+
+    if not content_encoding:
+        return feed, close
+
+    make_decompressor, make_compressor = CONTENT_CODINGS[content_encoding]
+    decompressor = make_decompressor()
+    compressor = make_compressor()
+
+    def feed_compressed(chunk):
+        output = [compressor.compress(feed(data))
+                  for data in iter_decompressed(decompressor, chunk)]
+        output.append(compressor.flush(zlib.Z_SYNC_FLUSH))
+        return b''.join(output)
+
+    def close_compressed():
+        output = compressor.compress(feed(decompressor.flush()))
+        return output + compressor.compress(close()) + compressor.flush()
+
+    return feed_compressed, close_compressed
+
+
+def get_stream_highlighter(terms, encoding=None, content_encoding=None):
+    """
+    Returns the feed and close functions highlighting
+    a stream of HTML chunks, decoded and encoded
+    with the encoding if provided, decompressed and
+    compressed with the content coding if provided.
+    """
+    return get_stream_functions(
+        Highlighter(terms), encoding, content_encoding)
+
+
+def find_compressed_terms(content, terms, charset, content_encoding,
+                          max_size=None, highlighter=None):
+    """
+    Tells if any of the terms occurs in the HTML content encoded
+    with charset and compressed with the content coding, block by
+    block, raising ContentTooLarge once more than max_size bytes
+    are decompressed, and HighlightTimeout once the highlighter
+    is expired.
+    """
+    prefilter = get_prefilter(terms)
+    overlap = max(len(term) for term in terms) - 1
+    decoder = codecs.getincrementaldecoder(charset)('surrogateescape')
+    found = False
+    size = 0
+    text = ''
+    for data in iter_decompressed_content(content, content_encoding):
+        size += len(data)
+        if max_size is not None and size > max_size:
+            raise ContentTooLarge
+        if highlighter is not None and highlighter.expired():
+            raise HighlightTimeout
+        if not found:
+            # Keep the end of the text, which can begin a term
+            text = text[max(0, len(text) - overlap):] + decoder.decode(
+                data)
+            found = prefilter.search(text) is not None
+        if found and max_size is None:
+            break
+    return found
+
+
+def highlight_compressed(content, terms, charset, budget=None,
+                         content_encoding=None, max_size=None):
+    """
+    Highlight the terms in the HTML content encoded with charset
+    and compressed with the content coding, block by block, within
+    budget seconds, as highlight_bytes does, returning the highlighted
+    content compressed again, empty if nothing has been highlighted
+    or if the content can not be decompressed, and if the highlighting
+    has been degraded, the content being then left untouched.
+    The content is first decompressed for finding the terms, raising
+    ContentTooLarge once more than max_size bytes are decompressed.
+    """
+    if not terms:
+        return b'', False
+    highlighter = Highlighter(terms, budget)
+    try:
+        if not find_compressed_terms(content, terms, charset,
+                                     content_encoding, max_size,
+                                     highlighter):
+            return b'', False
+        feed, close = get_stream_functions(
+            highlighter, charset, content_encoding)
+        output = []
+        for position in range(0, len(content), DECOMPRESS_SIZE):
+            output.append(feed(content[position:position + DECOMPRESS_SIZE]))
+            if highlighter.degraded:
+                break
+        else:
+            output.append(close())
+    except CODING_ERRORS:
+        return b'', False
+    except HighlightTimeout:
+        return b'', True
+    if highlighter.degraded:
+        return b'', True
+    if not highlighter.updated:
+        return b'', False
+    return b''.join(output), False
+
+
+def highlight_stream(chunks, terms, encoding=None, content_encoding=None):
+    """
+    Highlight the terms in an iterable of HTML chunks,
+    yielding the highlighted chunks as they come.
+    If an encoding is provided, the chunks are decoded
+    and encoded with it, and decompressed and compressed
+    with the content coding if provided.
+    """
+    feed, close = get_stream_highlighter(terms, encoding, content_encoding)
+    for chunk in chunks:
+        output = feed(chunk)
+        if output:
+            yield output
+    output = close()
+    if output:
+        yield output
+
+
+async def ahighlight_stream(chunks, terms, encoding=None,
+                            content_encoding=None):
+    """
+    Highlight the terms in an asynchronous iterable of HTML chunks,
+    like highlight_stream, each chunk being highlighted in the pool
+    of threads for not blocking the event loop, even if the pages
+    are highlighted in the pool of processes, as the highlighter
+    of the stream keeps its state between the chunks.
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_thread_pool()
+    feed, close = get_stream_highlighter(terms, encoding, content_encoding)
+    async for chunk in chunks:
+        output = await loop.run_in_executor(pool, feed, chunk)
+        if output:
+            yield output
+    output = await loop.run_in_executor(pool, close)
+    if output:
+        yield output
+
+
+executor = None
+process_pool = None
+executor_lock = Lock()
+process_pool_lock = Lock()
+
+# Tells if the current process is a worker of the pool of processes
+worker = False
+
+
+def init_worker():
+    """
+    Warm a worker of the pool of processes.
+    """
+    global worker
+    worker = True
+    highlight('<p>sekh</p>', ['sekh'])
+
+
+def get_process_context():
+    """
+    Returns the context starting the workers of the pool of processes
+    from a fresh process, the pool being created from the threads
+    of a worker, whose locks held by the other threads would be
+    copied as locked in the forked processes.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def get_process_pool():
+    """
+    Returns the persistent pool of processes,
+    created with its workers warmed on the first call.
+    """
+    global process_pool
+    with process_pool_lock:
+        if process_pool is None:
+            workers = EXECUTOR_WORKERS or os.cpu_count() or 1
+            process_pool = ProcessPoolExecutor(
+                workers, mp_context=get_process_context(),
+                initializer=init_worker)
+            # Start all the workers now rather than on demand
+            for future in [process_pool.submit(int)
+                           for i in range(workers)]:
+                future.result()
+        return process_pool
+
+
+def reset_process_pool(pool=None, terminate=False):
+    """
+    Discard the pool of processes, or only if it is still pool,
+    which is created again on the next call of get_process_pool.
+    All its workers are terminated if terminate, so all the pages
+    they are highlighting, for the other requests too, are left
+    untouched and degraded.
+    """
+    global process_pool
+    with process_pool_lock:
+        if process_pool is None or pool not in (None, process_pool):
+            return
+        discarded = process_pool
+        process_pool = None
+    if not terminate:
+        discarded.shutdown(wait=False, cancel_futures=True)
+    elif hasattr(discarded, 'terminate_workers'):  # Python >= 3.14
+        discarded.terminate_workers()
+    else:
+        processes = list((discarded._processes or {}).values())
+        discarded.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+
+
+def get_thread_pool():
+    """
+    Returns the pool of threads of HIGHLIGHT_EXECUTOR_WORKERS
+    workers, created on the first call.
+    """
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(EXECUTOR_WORKERS)
+        return executor
+
+
+def get_executor():
+    """
+    Returns the pool where the pages are highlighted
+    asynchronously, created on the first call.
+    """
+    if EXECUTOR == 'process':
+        return get_process_pool()
+    if EXECUTOR != 'thread':
+        raise ImproperlyConfigured(
+            'HIGHLIGHT_EXECUTOR must be thread or process')
+    return get_thread_pool()
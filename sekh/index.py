@@ -0,0 +1,242 @@
+"""Index of the words of the pages for django-sekh"""
+import re
+from array import array
+from time import monotonic
+from hashlib import md5
+
+from django.core.cache import caches
+
+from sekh.utils import get_pattern
+from sekh.utils import remove_duplicates
+from sekh.metrics import record
+from sekh.highlighting import MARKUP_RE
+from sekh.highlighting import RAW_TEXT_MARKUPS
+from sekh.highlighting import WATCHED_MARKUPS
+from sekh.highlighting import BaseHighlighter
+from sekh.highlighting import highlight_in_time
+from sekh.highlighting import highlight_content
+from sekh.settings import INDEX_CACHE
+from sekh.settings import INDEX_TIMEOUT
+from sekh.settings import HIGHLIGHTING_PATTERN
+
+WORD_RE = re.compile(r'\S+', re.U)
+
+
+class TermIndex(object):
+    """
+    Offsets of the words in the text nodes of a HTML content
+    which can be highlighted, for highlighting any terms
+    by splicing the content, without parsing it.
+    """
+
+    def __init__(self, words=None):
+        self.words = words if words is not None else {}
+
+    def add(self, word, offset):
+        offsets = self.words.get(word)
+        if offsets is None:
+            offsets = self.words[word] = array('I')
+        offsets.append(offset)
+
+    def find(self, terms):
+        """
+        Returns the (start, end, index) of the terms found in
+        the indexed content as the regex backend would find them,
+        the terms being matched in each distinct word only.
+        """
+        pattern = get_pattern(terms)
+        hits = []
+        for word, offsets in self.words.items():
+            word_hits = list(pattern.finditer(word))
+            if not word_hits:
+                continue
+            for offset in offsets:
+                for start, end, index in word_hits:
+                    hits.append((offset + start, offset + end, index))
+        hits.sort()
+        return hits
+
+    def highlight(self, content, terms, hits=None):
+        """
+        Highlight the terms in the indexed content by splicing it
+        at the hits, returning the content itself if nothing
+        has been highlighted.
+        """
+        if hits is None:
+            hits = self.find(terms)
+        if not hits:
+            return content
+
+        pieces = []
+        position = 0
+        for start, end, index in hits:
+            pieces.append(content[position:start])
+            pieces.append(HIGHLIGHTING_PATTERN % {
+                'index': index + 1, 'term': content[start:end]})
+            position = end
+        pieces.append(content[position:])
+        return ''.join(pieces)
+
+    def serialize(self):
+        """
+        Returns the index in a compact form, the words joined
+        by new lines, their number of offsets and the offsets
+        as bytes.
+        """
+        counts = array('I')
+        offsets = array('I')
+        for word_offsets in self.words.values():
+            counts.append(len(word_offsets))
+            offsets.extend(word_offsets)
+        return ('\n'.join(self.words), counts.tobytes(), offsets.tobytes())
+
+    @classmethod
+    def deserialize(cls, data):
+        """
+        Returns the index from its serialized form.
+        """
+        vocabulary, counts_bytes, offsets_bytes = data
+        counts = array('I')
+        counts.frombytes(counts_bytes)
+        offsets = array('I')
+        offsets.frombytes(offsets_bytes)
+
+        words = {}
+        position = 0
+        for word, count in zip(vocabulary.split('\n'), counts):
+            words[word] = offsets[position:position + count]
+            position += count
+        return cls(words)
+
+
+class Indexer(BaseHighlighter):
+    """
+    Index the words of the text nodes of a HTML content
+    which are not inside a protected markup, tokenizing
+    the markup as the regex backend does.
+    """
+
+    def __init__(self, budget=None):
+        super(Indexer, self).__init__((), budget)
+
+    def index(self, content):
+        """
+        Returns the index of the whole content,
+        or None if the time budget is exhausted.
+        """
+        index = TermIndex()
+        raw_text = None
+        position = 0
+        length = len(content)
+
+        while position < length:
+            if raw_text is not None:
+                closing = raw_text.search(content, position)
+                position = closing.start() if closing else length
+                raw_text = None
+                continue
+
+            match = MARKUP_RE.search(content, position)
+            end = match.start() if match else length
+            if end > position and not self.protected:
+                if self.expired():
+                    return None
+                for word in WORD_RE.finditer(content, position, end):
+                    index.add(word.group(), word.start())
+            if match is None:
+                break
+
+            position = match.end()
+            name = match.group('tag')
+            if name and name.lower() in WATCHED_MARKUPS:
+                markup = match.group(0)
+                self.handle_tag(name, markup)
+                if markup[1] != '/':
+                    raw_text = RAW_TEXT_MARKUPS.get(name.lower())
+        return index
+
+
+def get_index_key(content):
+    """
+    Build the cache key of the index of a content.
+    """
+    return 'sekh.index.%s' % md5(
+        content.encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+def index_content(content, budget=None):
+    """
+    Index the HTML content and store its index in the cache
+    HIGHLIGHT_INDEX_CACHE, when publishing the content for example,
+    returning None if not indexed within budget seconds.
+    """
+    index = Indexer(budget).index(content)
+    if index is None:
+        return None
+    caches[INDEX_CACHE].set(get_index_key(content),
+                            index.serialize(), INDEX_TIMEOUT)
+    return index
+
+
+def get_index(content, budget=None):
+    """
+    Returns the index of the HTML content from the cache,
+    indexing the content within budget seconds if needed.
+    """
+    data = caches[INDEX_CACHE].get(get_index_key(content))
+    if data is None:
+        return index_content(content, budget)
+    return TermIndex.deserialize(data)
+
+
+def highlight_indexed(content, terms, budget=None):
+    """
+    Highlight the terms in the HTML content with its index,
+    returning the highlighted content and if the highlighting
+    has been degraded, the content being then left untouched
+    if not highlighted within budget seconds. The content is
+    highlighted with the backend if there is no cache of indexes,
+    or if a term contains spaces.
+    """
+    terms = remove_duplicates(terms)
+    if INDEX_CACHE is None or any(
+            char.isspace() for term in terms for char in term):
+        return highlight_in_time(content, terms, budget)
+
+    start = monotonic()
+    index = get_index(content, budget)
+    hits = index.find(terms) if index is not None else None
+    if hits is None or (budget is not None and
+                        monotonic() - start > budget):
+        record('highlight', monotonic() - start, size=len(content),
+               terms=len(terms), matches=0, added=0, outcome='degraded')
+        return content, True
+    output = index.highlight(content, terms, hits)
+    record('highlight', monotonic() - start, size=len(content),
+           terms=len(terms), matches=len(hits),
+           added=len(output) - len(content),
+           outcome=hits and 'indexed' or 'no-match')
+    return output, False
+
+
+def highlight_indexed_bytes(content, terms, charset, budget=None):
+    """
+    Highlight the terms in the HTML content encoded with charset,
+    with its index, in the current process, the bytes not matching
+    the charset being kept as they are.
+    """
+    text = content.decode(charset, 'surrogateescape')
+    highlighted_text, degraded = highlight_indexed(text, terms, budget)
+    if highlighted_text is text:
+        return b'', degraded
+    return highlighted_text.encode(charset, 'surrogateescape'), degraded
+
+
+def highlight_indexed_content(content, terms, charset, budget=None):
+    """
+    Highlight the terms in the HTML content encoded with charset,
+    with its index, as highlight_content does, the large
+    contents being offloaded in the pool of processes.
+    """
+    return highlight_content(content, terms, charset, budget,
+                             highlight_indexed_bytes)
@@ -0,0 +1,79 @@
+"""Metrics for django-sekh"""
+import re
+import socket
+from threading import Lock
+
+from django.utils.module_loading import import_string
+
+from sekh.signals import measured
+from sekh.settings import METRICS_SINK
+from sekh.settings import STATSD_PREFIX
+from sekh.settings import STATSD_ADDRESS
+
+STATSD_NAME_RE = re.compile(r'[^\w.-]+')
+
+sink = None
+sink_lock = Lock()
+
+
+def get_sink():
+    """
+    Returns the sink of the metrics set by HIGHLIGHT_METRICS_SINK,
+    created on the first call, or None.
+    """
+    global sink
+    if METRICS_SINK is None:
+        return None
+    with sink_lock:
+        if sink is None:
+            sink = import_string(METRICS_SINK)()
+        return sink
+
+
+def record(name, duration, **metrics):
+    """
+    Send the duration in seconds and the metrics of an operation
+    to the receivers of the measured signal and to the sink.
+    """
+    if measured.receivers:
+        measured.send(sender=None, name=name,
+                      duration=duration, metrics=metrics)
+    if METRICS_SINK is not None:
+        get_sink()(name, duration, metrics)
+
+
+class StatsdSink(object):
+    """
+    Send the metrics to a StatsD server over UDP, the durations
+    as timings in milliseconds, the outcomes as counters and
+    the other metrics as histograms.
+    """
+
+    def __init__(self, address=STATSD_ADDRESS, prefix=STATSD_PREFIX):
+        self.prefix = prefix
+        family, kind, protocol, name, self.address = socket.getaddrinfo(
+            address[0], address[1], 0, socket.SOCK_DGRAM)[0]
+        self.socket = socket.socket(family, kind, protocol)
+        self.socket.setblocking(False)
+
+    def format(self, name, duration, metrics):
+        """
+        Returns the lines of the StatsD protocol for the metrics.
+        """
+        name = '%s.%s' % (self.prefix, name)
+        lines = ['%s.time:%.3f|ms' % (name, duration * 1000)]
+        for key, value in sorted(metrics.items()):
+            if key == 'outcome':
+                lines.append('%s.%s:1|c' % (
+                    name, STATSD_NAME_RE.sub('_', str(value))))
+            else:
+                lines.append('%s.%s:%s|h' % (name, key, value))
+        return '\n'.join(lines)
+
+    def __call__(self, name, duration, metrics):
+        try:
+            self.socket.sendto(
+                self.format(name, duration, metrics).encode('utf-8'),
+                self.address)
+        except socket.error:
+            pass
@@ -3,37 +3,88 @@ Middleware for highlighing the keywords
 of an user's search in a HTML page based on
 http://www.djangosnippets.org/snippets/197/
 """
-import re
-try:
-    from urllib.parse import urlsplit
-    from urllib.parse import parse_qs
-except ImportError:  # Python 2
-    from urlparse import urlsplit
-    from urlparse import parse_qs
+import asyncio
+from time import monotonic
+from functools import partial
+from hashlib import md5
+from urllib.parse import urlsplit
+from urllib.parse import parse_qs
 
+from django.conf import settings
+from django.core.cache import caches
+from asgiref.sync import sync_to_async
+from asgiref.sync import iscoroutinefunction
+from asgiref.sync import markcoroutinefunction
+
+from sekh.settings import CACHE
+from sekh.settings import INDEX_CACHE
+from sekh.settings import MAX_SIZE
+from sekh.settings import TIME_BUDGET
+from sekh.settings import SERVER_TIMING
+from sekh.settings import DEGRADED_HEADER
+from sekh.settings import CACHE_TIMEOUT
+from sekh.settings import CACHE_MAX_SIZE
 from sekh.settings import GET_VARNAMES
-from sekh.highlighting import highlight
+from sekh.settings import EXCLUDED_PATHS
+from sekh.settings import SEARCH_ENGINES
+from sekh.settings import HIGHLIGHTING_PATTERN
+from sekh.settings import REFERRER_CACHE_SIZE
+from sekh.signals import highlight_degraded
+from sekh.metrics import record
+from sekh.highlighting import get_executor
+from sekh.highlighting import highlight_stream
+from sekh.highlighting import CONTENT_CODINGS
+from sekh.highlighting import highlight_content
+from sekh.highlighting import highlight_compressed
+from sekh.highlighting import ContentTooLarge
+from sekh.highlighting import ahighlight_stream
+from sekh.index import highlight_indexed_content
+from sekh.utils import get_prefilter
+from sekh.utils import LRUCache
+from sekh.utils import DomainTrie
 from sekh.utils import remove_duplicates
 
+networks_cache = LRUCache(REFERRER_CACHE_SIZE)
+
 
 class BaseSearchReferrer(object):
 
-    SEARCH_PARAMS = {
-        'Ask': 'q',
-        'Baidu': 'wd',
-        'Bing': 'q',
-        'Google': 'q',
-        'Hotbot': 'q',
-        'Lycos': 'query',
-        'Yahoo': 'p',
-    }
-
-    NETWORK_RE = r"""^
-    (?P<subdomain>[-.a-z\d]+\.)?
-    (?P<engine>%s)
-    (?P<top_level>(?:\.[a-z]{2,3}){1,2})
-    (?P<port>:\d+)?
-    $(?ix)"""
+    SEARCH_PARAMS = SEARCH_ENGINES
+
+    def get_engines_trie(self):
+        """
+        Index once per class the search engines by domain,
+        an engine being found by its lowercased name unless
+        its domains are given after its parameter of search.
+        """
+        klass = self.__class__
+        trie = klass.__dict__.get('_engines_trie')
+        if trie is None:
+            trie = klass._engines_trie = DomainTrie()
+            for engine, param in klass.SEARCH_PARAMS.items():
+                domains = [engine]
+                if not isinstance(param, str):
+                    param, domains = param[0], param[1:]
+                for domain in domains:
+                    trie.add(domain, (engine, param))
+        return trie
+
+    def get_search_engine(self, network):
+        """
+        Returns the search engine of the network and its
+        parameter of search, or (None, None), from the cache
+        of the networks already seen if possible.
+        """
+        key = (self.__class__, network)
+        engine = networks_cache.get(key)
+        if engine is None:
+            host, colon, port = network.partition(':')
+            engine = None
+            if not colon or port.isdigit():
+                engine = self.get_engines_trie().lookup(host)
+            engine = engine or (None, None)
+            networks_cache.set(key, engine)
+        return engine
 
     def parse_search(self, url):
         """
@@ -46,6 +97,16 @@ class BaseSearchReferrer(object):
         The first tuple item will be None if the referrer is not a
         search engine.
         """
+        start = monotonic()
+        search = self.parse_referrer(url)
+        record('parse_search', monotonic() - start,
+               terms=len(search[2]), outcome=search[0] or 'none')
+        return search
+
+    def parse_referrer(self, url):
+        """
+        Extract the search from the referrer, without measuring it.
+        """
         try:
             parsed = urlsplit(url)
             network = parsed[1]
@@ -54,13 +115,12 @@ class BaseSearchReferrer(object):
             return (None, None, [])
         if not network:
             return (None, None, [])
-        for engine, param in self.SEARCH_PARAMS.items():
-            match = re.match(self.NETWORK_RE % engine, network)
-            if match and match.group(2):
-                terms = parse_qs(query).get(param)
-                if terms:
-                    terms = [term.lower() for term in terms[0].split()]
-                    return (engine, network, terms)
+        engine, param = self.get_search_engine(network)
+        if engine is not None:
+            terms = parse_qs(query).get(param)
+            if terms:
+                terms = [term.lower() for term in terms[0].split()]
+                return (engine, network, terms)
         return (None, network, [])
 
 
@@ -68,15 +128,51 @@ class KeywordsHighlightingMiddleware(BaseSearchReferrer):
     """
     Middleware highlighting keywords on a html page
     by adding a markup with classes.
+    Usable as a synchronous or an asynchronous middleware.
     """
+    sync_capable = True
+    async_capable = True
 
-    def process_response(self, request, response):
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+        self.async_mode = (get_response is not None and
+                           iscoroutinefunction(get_response))
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        self.process_request(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        self.process_request(request)
+        response = await self.get_response(request)
+        return await self.aprocess_response(request, response)
+
+    def process_request(self, request):
         """
-        Transform the HTML if keywords are present.
+        Work out once the terms to highlight in the response.
+        """
+        request._highlight_terms = self.get_request_terms(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
         """
-        if (response.status_code != 200 or
-                not 'text/html' in response['Content-Type']):
-            return response
+        Skip the views decorated by no_highlight.
+        """
+        if getattr(view_func, 'no_highlight', False):
+            request._highlight_terms = []
+
+    def get_request_terms(self, request):
+        """
+        Returns the terms searched by the request, none for the
+        HEAD requests and the paths in HIGHLIGHT_EXCLUDED_PATHS.
+        """
+        if request.method == 'HEAD' or (
+                EXCLUDED_PATHS and request.path.startswith(
+                    tuple(EXCLUDED_PATHS))):
+            return []
 
         referrer = request.META.get('HTTP_REFERER')
         engine, domain, terms = self.parse_search(referrer)
@@ -85,9 +181,301 @@ class KeywordsHighlightingMiddleware(BaseSearchReferrer):
             if request.GET.get(GET_varname):
                 terms.extend(request.GET[GET_varname].split())
 
+        return remove_duplicates(terms)
+
+    def is_highlightable(self, response):
+        """
+        Tells if the response can be highlighted, without
+        looking at its content.
+        """
+        return (response.status_code == 200 and
+                'text/html' in response.get('Content-Type', '') and
+                response.get('Content-Length') != '0')
+
+    def get_terms(self, request, response):
+        """
+        Returns the terms to highlight in the response.
+        """
+        if not self.is_highlightable(response):
+            return []
+
+        terms = getattr(request, '_highlight_terms', None)
+        if terms is None:
+            terms = self.get_request_terms(request)
+        return terms
+
+    def get_charset(self, response):
+        return getattr(response, 'charset', None) or \
+            settings.DEFAULT_CHARSET
+
+    def process_response(self, request, response):
+        """
+        Transform the HTML if keywords are present.
+        """
+        start = monotonic()
+        metrics = self.highlight_response(request, response, start)
+        return self.measure(response, start, metrics)
+
+    async def aprocess_response(self, request, response):
+        """
+        Transform the HTML if keywords are present, the highlighting
+        and the cache being run out of the event loop.
+        """
+        start = monotonic()
+        metrics = await self.ahighlight_response(request, response, start)
+        return self.measure(response, start, metrics)
+
+    def highlight_response(self, request, response, start):
+        """
+        Highlight the response in place, returning its metrics.
+        """
+        terms = self.get_terms(request, response)
         if not terms:
-            return response
+            return {'outcome': 'skipped'}
+        metrics = {'terms': len(terms)}
+
+        if self.is_too_large(response):
+            self.degrade(request, response, 'size')
+            return dict(metrics, outcome='degraded')
 
-        response.content = highlight(response.content,
-                                     remove_duplicates(terms))
+        charset = self.get_charset(response)
+        content_encoding = self.get_content_encoding(response)
+        if content_encoding and content_encoding not in CONTENT_CODINGS:
+            return dict(metrics, outcome='unsupported')
+        if getattr(response, 'streaming', False):
+            self.process_streaming_response(
+                response, terms, charset, content_encoding)
+            return dict(metrics, outcome='streamed')
+
+        content = response.content
+        metrics['size'] = len(content)
+        if not content_encoding and not self.contains_terms(
+                content, terms, charset):
+            return dict(metrics, outcome='no-match')
+
+        highlighted_content = None
+        cache = self.get_content_cache(content)
+        if cache is not None:
+            key = self.get_cache_key(content, terms, charset)
+            highlighted_content = cache.get(key)
+            metrics['outcome'] = 'cached'
+        if highlighted_content is None:
+            highlighter = self.get_content_highlighter(content_encoding)
+            try:
+                highlighted_content, degraded = highlighter(
+                    content, terms, charset, self.get_budget(start))
+            except ContentTooLarge:
+                self.degrade(request, response, 'size')
+                return dict(metrics, outcome='degraded')
+            if degraded:
+                self.update_response(response, highlighted_content)
+                self.degrade(request, response, 'timeout')
+                return dict(metrics, outcome='degraded')
+            if cache is not None:
+                cache.set(key, highlighted_content, CACHE_TIMEOUT)
+            metrics['outcome'] = 'highlighted'
+
+        self.update_response(response, highlighted_content)
+        return self.get_content_metrics(metrics, highlighted_content)
+
+    async def ahighlight_response(self, request, response, start):
+        """
+        Highlight the response in place, returning its metrics,
+        the highlighting and the cache being run in threads
+        or processes.
+        """
+        terms = self.get_terms(request, response)
+        if not terms:
+            return {'outcome': 'skipped'}
+        metrics = {'terms': len(terms)}
+
+        if self.is_too_large(response):
+            self.degrade(request, response, 'size')
+            return dict(metrics, outcome='degraded')
+
+        charset = self.get_charset(response)
+        content_encoding = self.get_content_encoding(response)
+        if content_encoding and content_encoding not in CONTENT_CODINGS:
+            return dict(metrics, outcome='unsupported')
+        if getattr(response, 'streaming', False):
+            self.process_streaming_response(
+                response, terms, charset, content_encoding)
+            return dict(metrics, outcome='streamed')
+
+        content = response.content
+        metrics['size'] = len(content)
+        if not content_encoding and not self.contains_terms(
+                content, terms, charset):
+            return dict(metrics, outcome='no-match')
+
+        highlighted_content = None
+        cache = self.get_content_cache(content)
+        if cache is not None:
+            key = self.get_cache_key(content, terms, charset)
+            highlighted_content = await sync_to_async(
+                cache.get, thread_sensitive=False)(key)
+            metrics['outcome'] = 'cached'
+        if highlighted_content is None:
+            highlighter = self.get_content_highlighter(content_encoding)
+            try:
+                highlighted_content, degraded = await asyncio.get_running_loop(
+                ).run_in_executor(get_executor(), highlighter,
+                                  content, terms, charset,
+                                  self.get_budget(start))
+            except ContentTooLarge:
+                self.degrade(request, response, 'size')
+                return dict(metrics, outcome='degraded')
+            if degraded:
+                self.update_response(response, highlighted_content)
+                self.degrade(request, response, 'timeout')
+                return dict(metrics, outcome='degraded')
+            if cache is not None:
+                await sync_to_async(cache.set, thread_sensitive=False)(
+                    key, highlighted_content, CACHE_TIMEOUT)
+            metrics['outcome'] = 'highlighted'
+
+        self.update_response(response, highlighted_content)
+        return self.get_content_metrics(metrics, highlighted_content)
+
+    def get_content_highlighter(self, content_encoding=None):
+        """
+        Returns the function highlighting the contents, with
+        the index of their words if HIGHLIGHT_INDEX_CACHE is set,
+        or block by block if compressed with the content coding,
+        up to HIGHLIGHT_MAX_SIZE bytes once decompressed.
+        """
+        if content_encoding:
+            return partial(highlight_content, highlighter=partial(
+                highlight_compressed, content_encoding=content_encoding,
+                max_size=MAX_SIZE))
+        if INDEX_CACHE is None:
+            return highlight_content
+        return highlight_indexed_content
+
+    def get_content_metrics(self, metrics, highlighted_content):
+        """
+        Complete the metrics with the bytes added by the highlighting.
+        """
+        if not highlighted_content:
+            if metrics['outcome'] == 'highlighted':
+                metrics['outcome'] = 'unchanged'
+            return dict(metrics, added=0)
+        return dict(metrics, added=len(highlighted_content) - metrics['size'])
+
+    def measure(self, response, start, metrics):
+        """
+        Record the metrics of the middleware on a response
+        and announce its duration in the Server-Timing header.
+        """
+        duration = monotonic() - start
+        record('middleware', duration, **metrics)
+        if SERVER_TIMING and metrics['outcome'] != 'skipped':
+            timing = 'sekh;dur=%.3f;desc="%s"' % (
+                duration * 1000, metrics['outcome'])
+            if response.has_header('Server-Timing'):
+                timing = '%s, %s' % (response['Server-Timing'], timing)
+            response['Server-Timing'] = timing
+        return response
+
+    def get_budget(self, start):
+        """
+        Returns the seconds left for highlighting a response
+        processed since start, or None if unlimited.
+        """
+        if TIME_BUDGET is None:
+            return None
+        return max(0, TIME_BUDGET - (monotonic() - start))
+
+    def is_too_large(self, response):
+        """
+        Tells if the body of the response is too large to be
+        highlighted, the streaming responses being checked
+        by their Content-Length if provided.
+        """
+        if MAX_SIZE is None:
+            return False
+        if getattr(response, 'streaming', False):
+            try:
+                return int(response.get('Content-Length')) > MAX_SIZE
+            except (TypeError, ValueError):
+                return False
+        return len(response.content) > MAX_SIZE
+
+    def degrade(self, request, response, reason):
+        """
+        Record that the response has not been fully highlighted.
+        """
+        if DEGRADED_HEADER:
+            response[DEGRADED_HEADER] = reason
+        highlight_degraded.send(sender=self.__class__, request=request,
+                                response=response, reason=reason)
+        return response
+
+    def process_streaming_response(self, response, terms, charset,
+                                   content_encoding=None):
+        """
+        Highlight the content of the response on the fly,
+        decompressed and compressed again if it is encoded.
+        """
+        if response.is_async:
+            response.streaming_content = ahighlight_stream(
+                response.streaming_content, terms, charset,
+                content_encoding)
+        else:
+            response.streaming_content = highlight_stream(
+                response.streaming_content, terms, charset,
+                content_encoding)
+        if response.has_header('Content-Length'):
+            del response['Content-Length']
         return response
+
+    def get_content_encoding(self, response):
+        """
+        Returns the lowercased coding of the content
+        of the response, or None if not compressed.
+        """
+        content_encoding = response.get('Content-Encoding', '')
+        content_encoding = content_encoding.strip().lower()
+        if content_encoding in ('', 'identity'):
+            return None
+        return content_encoding
+
+    def update_response(self, response, highlighted_content):
+        """
+        Replace the content of the response, an empty content
+        meaning that nothing has been highlighted.
+        """
+        if highlighted_content:
+            response.content = highlighted_content
+            if response.has_header('Content-Length'):
+                response['Content-Length'] = str(len(response.content))
+        return response
+
+    def contains_terms(self, content, terms, charset):
+        """
+        Tells if any of the terms occurs in the encoded content,
+        without decoding it if possible.
+        """
+        prefilter = get_prefilter(terms, charset)
+        if prefilter is None:
+            prefilter = get_prefilter(terms)
+            content = content.decode(charset, 'surrogateescape')
+        return prefilter.search(content) is not None
+
+    def get_content_cache(self, content):
+        """
+        Returns the cache where the highlighted content
+        can be stored, or None.
+        """
+        if CACHE is None or len(content) > CACHE_MAX_SIZE:
+            return None
+        return caches[CACHE]
+
+    def get_cache_key(self, content, terms, charset):
+        """
+        Build the cache key of a content highlighted with terms.
+        """
+        digest = md5(content)
+        digest.update('\x00'.join(
+            [charset, HIGHLIGHTING_PATTERN] + terms).encode('utf-8'))
+        return 'sekh.highlight.%s' % digest.hexdigest()
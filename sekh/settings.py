@@ -5,10 +5,38 @@ GET_VARNAMES = getattr(
     settings, 'HIGHLIGHT_GET_VARNAMES',
     ('highlight', 'hl', 'q', 'query', 'pattern'))
 
+SEARCH_ENGINES = getattr(
+    settings, 'HIGHLIGHT_SEARCH_ENGINES',
+    {'AOL': 'q',
+     'Ask': 'q',
+     'Baidu': 'wd',
+     'Bing': 'q',
+     'Brave': 'q',
+     'Daum': 'q',
+     'DuckDuckGo': 'q',
+     'Ecosia': 'q',
+     'Google': 'q',
+     'Hotbot': 'q',
+     'Lycos': 'query',
+     'Mojeek': 'q',
+     'Naver': 'query',
+     'Qwant': 'q',
+     'Seznam': 'q',
+     'Sogou': 'query',
+     'Startpage': 'query',
+     'Yahoo': 'p',
+     'Yandex': ('text', 'yandex', 'ya')})
+
+EXCLUDED_PATHS = getattr(
+    settings, 'HIGHLIGHT_EXCLUDED_PATHS', ())
+
 PROTECTED_MARKUPS = getattr(
     settings, 'HIGHLIGHT_PROTECTED_MARKUPS',
     ('code', 'script', 'pre'))
 
+PARSER = getattr(
+    settings, 'HIGHLIGHT_PARSER', 'regex')
+
 HIGHLIGHTING_PATTERN = getattr(
     settings, 'HIGHLIGHT_HIGHLIGHTING_PATTERN',
     '<span class="highlight term-%(index)s">%(term)s</span>')
@@ -16,5 +44,65 @@ HIGHLIGHTING_PATTERN = getattr(
 EXCERPT_MAX_LENGTH = getattr(
     settings, 'HIGHLIGHT_EXCERPT_MAX_LENGTH', 50)
 
+PATTERN_CACHE_SIZE = getattr(
+    settings, 'HIGHLIGHT_PATTERN_CACHE_SIZE', 128)
+
 EXCERPT_MATCH_WINDOW_SIZE = getattr(
     settings, 'HIGHLIGHT_EXCERPT_MATCH_WINDOW_SIZE', 5)
+
+EXCERPT_NUMPY_THRESHOLD = getattr(
+    settings, 'HIGHLIGHT_EXCERPT_NUMPY_THRESHOLD', 100000)
+
+AUTOMATON_THRESHOLD = getattr(
+    settings, 'HIGHLIGHT_AUTOMATON_THRESHOLD', 10)
+
+CACHE = getattr(
+    settings, 'HIGHLIGHT_CACHE', None)
+
+CACHE_TIMEOUT = getattr(
+    settings, 'HIGHLIGHT_CACHE_TIMEOUT', 300)
+
+CACHE_MAX_SIZE = getattr(
+    settings, 'HIGHLIGHT_CACHE_MAX_SIZE', 1024 * 1024)
+
+INDEX_CACHE = getattr(
+    settings, 'HIGHLIGHT_INDEX_CACHE', None)
+
+INDEX_TIMEOUT = getattr(
+    settings, 'HIGHLIGHT_INDEX_TIMEOUT', 86400)
+
+REFERRER_CACHE_SIZE = getattr(
+    settings, 'HIGHLIGHT_REFERRER_CACHE_SIZE', 1024)
+
+EXECUTOR = getattr(
+    settings, 'HIGHLIGHT_EXECUTOR', 'thread')
+
+EXECUTOR_WORKERS = getattr(
+    settings, 'HIGHLIGHT_EXECUTOR_WORKERS', None)
+
+OFFLOAD_SIZE = getattr(
+    settings, 'HIGHLIGHT_OFFLOAD_SIZE', None)
+
+OFFLOAD_TIMEOUT = getattr(
+    settings, 'HIGHLIGHT_OFFLOAD_TIMEOUT', 10)
+
+TIME_BUDGET = getattr(
+    settings, 'HIGHLIGHT_TIME_BUDGET', None)
+
+MAX_SIZE = getattr(
+    settings, 'HIGHLIGHT_MAX_SIZE', None)
+
+DEGRADED_HEADER = getattr(
+    settings, 'HIGHLIGHT_DEGRADED_HEADER', 'X-Highlight-Degraded')
+
+METRICS_SINK = getattr(
+    settings, 'HIGHLIGHT_METRICS_SINK', None)
+
+STATSD_ADDRESS = getattr(
+    settings, 'HIGHLIGHT_STATSD_ADDRESS', ('localhost', 8125))
+
+STATSD_PREFIX = getattr(
+    settings, 'HIGHLIGHT_STATSD_PREFIX', 'sekh')
+
+SERVER_TIMING = getattr(
+    settings, 'HIGHLIGHT_SERVER_TIMING', True)
@@ -0,0 +1,10 @@
+"""Signals for django-sekh"""
+from django.dispatch import Signal
+
+# Sent by the middleware with the request, the response
+# and the reason when a response is not fully highlighted
+highlight_degraded = Signal()
+
+# Sent after each measured operation with its name,
+# its duration in seconds and a dictionnary of metrics
+measured = Signal()
@@ -2,12 +2,16 @@
 import re
 
 from django import template
+from django.utils.safestring import SafeData
 from django.utils.safestring import mark_safe
-from django.utils.html import conditional_escape
 from django.template.defaultfilters import stringfilter
 
 from sekh.excerpt import excerpt
+from sekh.excerpt import excerpt_many
+from sekh.excerpt import excerpt_highlight
 from sekh.highlighting import highlight
+from sekh.highlighting import highlight_fragment
+from sekh.utils import get_pattern
 from sekh.utils import remove_duplicates
 from sekh.settings import EXCERPT_MAX_LENGTH
 
@@ -15,46 +19,85 @@ RE_ARG_SPLIT = re.compile(r'[ ;,]')
 register = template.Library()
 
 
-class HighLightNode(template.Node):
+def split_terms(terms):
+    """
+    Split the terms given as argument, without duplicates.
+    """
+    return remove_duplicates(RE_ARG_SPLIT.split(terms))
 
-    def __init__(self, nodelist, terms):
-        self.nodelist = nodelist
-        self.terms = terms
-        self.terms_var = template.Variable(terms)
 
-    def render(self, context):
-        output = self.nodelist.render(context)
+class TermsNode(template.Node):
+    """
+    Node using search terms, given literally and splitted once
+    when parsing, or by a variable splitted once per value
+    in the render context.
+    """
 
-        terms = self.terms
+    def __init__(self, terms):
         if terms[0] == terms[-1] and terms[0] in ("'", '"'):
-            terms = terms[1:-1]
+            self.terms = split_terms(terms[1:-1])
+            self.terms_var = None
+            get_pattern(self.terms)
         else:
-            terms = self.terms_var.resolve(context)
+            self.terms = None
+            self.terms_var = template.Variable(terms)
+
+    def get_terms(self, context):
+        if self.terms_var is None:
+            return self.terms
+
+        value = self.terms_var.resolve(context)
+        terms_cache = context.render_context.setdefault(self, {})
+        terms = terms_cache.get(value)
+        if terms is None:
+            terms = terms_cache[value] = split_terms(value)
+        return terms
+
 
-        return highlight(output,
-                         remove_duplicates(RE_ARG_SPLIT.split(terms)))
+class HighLightNode(TermsNode):
+
+    def __init__(self, nodelist, terms):
+        super(HighLightNode, self).__init__(terms)
+        self.nodelist = nodelist
+
+    def render(self, context):
+        output = self.nodelist.render(context)
+        return highlight(output, self.get_terms(context))
 
 
-class ExcerptNode(template.Node):
+class ExcerptNode(TermsNode):
 
     def __init__(self, nodelist, terms, max_length):
+        super(ExcerptNode, self).__init__(terms)
         self.nodelist = nodelist
-        self.terms = terms
-        self.terms_var = template.Variable(terms)
         self.max_length = max_length
 
     def render(self, context):
         output = self.nodelist.render(context)
+        return excerpt(output, self.get_terms(context), self.max_length)
 
-        terms = self.terms
-        if terms[0] == terms[-1] and terms[0] in ("'", '"'):
-            terms = terms[1:-1]
+
+class ExcerptManyNode(TermsNode):
+
+    def __init__(self, documents, terms, max_length, field, varname):
+        super(ExcerptManyNode, self).__init__(terms)
+        self.documents_var = template.Variable(documents)
+        self.max_length = max_length
+        self.field_var = field and template.Variable(field)
+        self.varname = varname
+
+    def render(self, context):
+        documents = list(self.documents_var.resolve(context))
+
+        if self.field_var:
+            field = template.Variable(self.field_var.resolve(context))
+            contents = [field.resolve(document) for document in documents]
         else:
-            terms = self.terms_var.resolve(context)
+            contents = documents
 
-        return excerpt(output,
-                       remove_duplicates(RE_ARG_SPLIT.split(terms)),
-                       self.max_length)
+        context[self.varname] = list(zip(documents, excerpt_many(
+            contents, self.get_terms(context), self.max_length)))
+        return ''
 
 
 @register.tag(name='highlight')
@@ -73,9 +116,16 @@ def highlight_tag(parser, token):
 @register.filter(name='highlight', needs_autoescape=True)
 @stringfilter
 def highlight_filter(value, terms, autoescape=None):
-    esc = autoescape and conditional_escape or (lambda x: x)
-    return mark_safe(highlight(esc(value),
-                               remove_duplicates(RE_ARG_SPLIT.split(terms))))
+    """
+    Highlight the terms in the value, the plain texts
+    being highlighted without parsing them as HTML.
+    """
+    terms = split_terms(terms)
+    if autoescape and not isinstance(value, SafeData):
+        return mark_safe(highlight_fragment(value, terms))
+    if '<' not in value and '&' not in value:
+        return mark_safe(highlight_fragment(value, terms, False))
+    return mark_safe(highlight(value, terms))
 
 
 @register.tag(name='excerpt')
@@ -99,5 +149,40 @@ def excerpt_tag(parser, token):
 @register.filter(name='excerpt')
 @stringfilter
 def excerpt_filter(value, terms):
-    return excerpt(value,
-                   remove_duplicates(RE_ARG_SPLIT.split(terms)))
+    return excerpt(value, split_terms(terms))
+
+
+@register.filter(name='excerpt_highlight', needs_autoescape=True)
+@stringfilter
+def excerpt_highlight_filter(value, terms, autoescape=None):
+    """
+    Same as excerpt followed by highlight,
+    without parsing the escaped excerpt.
+    """
+    terms = split_terms(terms)
+    if not autoescape:
+        return mark_safe(highlight(excerpt(value, terms), terms))
+    return mark_safe(excerpt_highlight(value, terms))
+
+
+@register.tag(name='excerpt_many')
+def excerpt_many_tag(parser, token):
+    """
+    {% excerpt_many documents terms [max_length] [field] as varname %}
+    stores the (document, excerpt) of each document in varname,
+    the text of the documents being their field if provided.
+    """
+    bits = token.split_contents()
+    if len(bits) < 5 or len(bits) > 7 or bits[-2] != 'as':
+        raise template.TemplateSyntaxError(
+            'excerpt_many tag requires documents, terms and a variable')
+
+    documents, terms = bits[1:3]
+    max_length = EXCERPT_MAX_LENGTH
+    field = None
+    for bit in bits[3:-2]:
+        if bit.isdigit():
+            max_length = int(bit)
+        else:
+            field = bit
+    return ExcerptManyNode(documents, terms, max_length, field, bits[-1])
@@ -7,3 +7,6 @@ DATABASES = {
 SECRET_KEY = 'secret-key'
 
 INSTALLED_APPS = ['sekh']
+
+TEMPLATES = [{'BACKEND': 'django.template.backends.django.DjangoTemplates',
+              'APP_DIRS': True}]
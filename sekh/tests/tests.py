@@ -1,21 +1,65 @@
 """Unit tests for django-sekh"""
+import re
+import gzip
+import time
+import random
+import zlib
+import socket
+from array import array
+from unittest import skipIf
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from asgiref.sync import iscoroutinefunction
 from django.test import TestCase
+from django.core.cache import caches
 from django.http import HttpRequest
 from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.template import Context
 from django.template import Template
 from django.template import TemplateSyntaxError
+from django.utils.html import escape
+from django.core.exceptions import ImproperlyConfigured
 
 from sekh.utils import list_range
 from sekh.utils import get_window
 from sekh.utils import get_min_index
 from sekh.utils import compile_terms
+from sekh.utils import compile_pattern
+from sekh.utils import LRUCache
+from sekh.utils import get_pattern
+from sekh.utils import get_prefilter
+from sekh.utils import TermsPattern
+from sekh.utils import TermsAutomaton
 from sekh.utils import remove_duplicates
+from sekh.settings import AUTOMATON_THRESHOLD
 from sekh.excerpt import excerpt
+from sekh.excerpt import excerpt_many
+from sekh.excerpt import excerpt_highlight
+from sekh.excerpt import iter_words
 from sekh.excerpt import shorten_excerpt
 from sekh.excerpt import shortest_term_span
 from sekh.excerpt import generate_term_positions
+from sekh import excerpt as excerpt_module
+from sekh.highlighting import BACKENDS
+from sekh.highlighting import Highlighter
 from sekh.highlighting import highlight
+from sekh.highlighting import get_highlighter
+from sekh.highlighting import highlight_stream
+from sekh.highlighting import highlight_content
+from sekh.highlighting import highlight_compressed
+from sekh.highlighting import highlight_fragment
+from sekh import highlighting
+from sekh import middleware
+from sekh import index as index_module
+from sekh.index import Indexer
+from sekh.index import TermIndex
+from sekh.signals import measured
+from sekh.decorators import no_highlight
+from sekh.signals import highlight_degraded
+from sekh.metrics import StatsdSink
+from sekh.middleware import BaseSearchReferrer
 from sekh.middleware import KeywordsHighlightingMiddleware
 
 
@@ -26,17 +70,17 @@ class TestRemoveDuplicates(TestCase):
     """Tests of remove_duplicates function"""
 
     def test_remove_duplicates(self):
-        self.assertEquals(
+        self.assertEqual(
             remove_duplicates(['titi', 'toto', 'tata', 'titi']),
             ['titi', 'toto', 'tata'])
 
     def test_remove_duplicates_with_spaces(self):
-        self.assertEquals(
+        self.assertEqual(
             remove_duplicates(['titi', 'toto', 'tata', ' titi']),
             ['titi', 'toto', 'tata'])
 
     def test_remove_duplicates_with_void_value(self):
-        self.assertEquals(
+        self.assertEqual(
             remove_duplicates(['titi', ' ', 'toto', '', ' titi']),
             ['titi', 'toto'])
 
@@ -49,13 +93,133 @@ class TestCompileTerms(TestCase):
         self.assertTrue(terms[0].match('TOTO'))
 
 
+class TestCompilePattern(TestCase):
+    """Test of compile_pattern function"""
+
+    def test_compile_pattern(self):
+        pattern = compile_pattern(['toto', 'titi'])
+        self.assertEqual(list(pattern.finditer('Titi and TOTO')),
+                         [(0, 4, 1), (9, 13, 0)])
+
+    def test_compile_pattern_none(self):
+        pattern = compile_pattern([])
+        self.assertEqual(list(pattern.finditer('Titi and TOTO')), [])
+
+
+class TestTermsAutomaton(TestCase):
+    """Tests of TermsAutomaton"""
+    terms = ['he', 'she', 'hers', 'HIS', u'\xe9t\xe9', 'e']
+    text = u'Ushers said his \xc9T\xc9 shell is here'
+
+    def test_finditer(self):
+        self.assertEqual(
+            list(TermsAutomaton(self.terms).finditer(self.text)),
+            list(TermsPattern(self.terms).finditer(self.text)))
+
+    def test_match(self):
+        automaton = TermsAutomaton(self.terms)
+        self.assertEqual(automaton.match('hershey'), 0)
+        self.assertEqual(automaton.match('His'), 3)
+        self.assertEqual(automaton.match('ushers'), None)
+
+    def test_search(self):
+        terms = ['abcd', 'bc']
+        self.assertEqual(TermsAutomaton(terms).search('xx abcd'), 3)
+        self.assertEqual(TermsAutomaton(terms).search('xx abcd', 4), 4)
+        self.assertEqual(TermsAutomaton(terms).search('xx abc'), 4)
+        self.assertEqual(TermsAutomaton(terms).search('xx'), -1)
+
+    def test_case_folds(self):
+        terms = ['s', 'kilo', 'is', u'\u03bb\u03cc\u03b3\u03bf\u03c2',
+                 u'\u03bcm'] + ['t%s' % i for i in
+                                range(AUTOMATON_THRESHOLD)]
+        automaton = compile_pattern(terms)
+        pattern = TermsPattern(terms)
+        self.assertTrue(isinstance(automaton, TermsAutomaton))
+        for text in (u'Mi\u017f\u017fi', u'\u212aILO',
+                     u'\u0130S \u0131s', u'x \u0130\u017f',
+                     u'\u039b\u038c\u0393\u039f\u03a3',
+                     u'\u03bb\u03cc\u03b3\u03bf\u03c3',
+                     u'\u03bb\u03cc\u03b3\u03bf\u03c2',
+                     u'\xb5m \u03bcm \u039cM'):
+            self.assertEqual(list(automaton.finditer(text)),
+                             list(pattern.finditer(text)))
+            self.assertEqual(automaton.search(text),
+                             pattern.search(text))
+            self.assertEqual(automaton.match(text), pattern.match(text))
+            self.assertTrue(list(automaton.finditer(text)))
+        self.assertEqual(
+            highlight(u'<p>\u039b\u038c\u0393\u039f\u03a3</p>', terms),
+            u'<p><span class="highlight term-4">'
+            u'\u039b\u038c\u0393\u039f\u03a3</span></p>')
+
+    def test_compile_pattern(self):
+        self.assertTrue(isinstance(
+            compile_pattern(self.terms[:2]), TermsPattern))
+        self.assertTrue(isinstance(
+            compile_pattern(['t%s' % i for i in
+                             range(AUTOMATON_THRESHOLD + 1)]),
+            TermsAutomaton))
+
+
+class TestLRUCache(TestCase):
+    """Tests of LRUCache"""
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.info(), {'hits': 2, 'misses': 1,
+                                        'evictions': 1, 'size': 2,
+                                        'max_size': 2})
+
+    def test_lru_cache_disabled(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
+
+
+class TestGetPattern(TestCase):
+    """Tests of get_pattern function"""
+
+    def test_get_pattern(self):
+        pattern = get_pattern(['toto', 'titi', ' toto'])
+        self.assertEqual(pattern.terms, ['toto', 'titi'])
+        self.assertTrue(get_pattern(['toto', 'titi']) is pattern)
+        self.assertFalse(get_pattern(['titi', 'toto']) is pattern)
+
+
+class TestGetPrefilter(TestCase):
+    """Tests of get_prefilter function"""
+
+    def test_get_prefilter(self):
+        prefilter = get_prefilter(['toto', 'titi'])
+        self.assertTrue(prefilter.search('A TiTi'))
+        self.assertFalse(prefilter.search('A tata'))
+        self.assertTrue(get_prefilter(['toto', 'titi']) is prefilter)
+
+    def test_get_prefilter_charset(self):
+        prefilter = get_prefilter(['toto', 'kiss'], 'utf-8')
+        self.assertTrue(prefilter.search(b'A ToTo'))
+        self.assertTrue(prefilter.search(
+            '\u212aiss'.encode('utf-8')))
+        self.assertFalse(prefilter.search(b'A tata'))
+        self.assertTrue(get_prefilter(['kiss'], 'latin-1').search(b'KISS'))
+        self.assertEqual(get_prefilter(['\xe9t\xe9'], 'utf-8'), None)
+        self.assertEqual(get_prefilter(['toto'], 'utf-16'), None)
+
+
 class TestListRange(TestCase):
     """Tests of list_range function"""
 
     def test_list_range(self):
-        self.assertEquals(
+        self.assertEqual(
             list_range([5, 6, 10]), 5)
-        self.assertEquals(
+        self.assertEqual(
             list_range([1, 7, 9]), 8)
 
 
@@ -63,7 +227,7 @@ class TestGetWindow(TestCase):
     """Tests of get_window function"""
 
     def test_get_window(self):
-        self.assertEquals(
+        self.assertEqual(
             get_window([[1, 2, 3], [4, 5, 6], [7, 8, 9]],
                        [0, 1, 2]), [1, 5, 9])
 
@@ -72,19 +236,19 @@ class TestGetMinIndex(TestCase):
     """Tests of get_min_index function"""
 
     def test_get_min_index(self):
-        self.assertEquals(
+        self.assertEqual(
             get_min_index([[1, 2, 3], [4, 5, 6], [7, 8, 9]],
                           [1, 5, 9]), 0)
-        self.assertEquals(
+        self.assertEqual(
             get_min_index([[1, 2, 3], [4, 5, 6], [7, 8, 9]],
                           [9, 5, 1]), 2)
-        self.assertEquals(
+        self.assertEqual(
             get_min_index([[1, 2, 3], [4, 5, 6], [7, 8, 0]],
                           [9, 5, 1]), 1)
-        self.assertEquals(
+        self.assertEqual(
             get_min_index([[1, 2, 3], [4, 5, 6], [7, 8, 9]],
                           [3, 5, 9]), 1)
-        self.assertEquals(
+        self.assertEqual(
             get_min_index([[1, 2, 3], [4, 5, 6], [7, 8, 9]],
                           [3, 6, 9]), None)
 
@@ -93,30 +257,30 @@ class TestHighlight(TestCase):
     """Tests of highlight function"""
 
     def test_highlight(self):
-        self.assertEquals(
+        self.assertEqual(
             highlight(HTML_CONTENT, ['Hello', 'world']),
             '<html><body><p><span class="highlight term-1">Hello</span> '
             '<span class="highlight term-2">world</span> !</p></body></html>')
 
     def test_highlight_case(self):
-        self.assertEquals(
+        self.assertEqual(
             highlight(HTML_CONTENT, ['HELLO', 'World']),
             '<html><body><p><span class="highlight term-1">Hello</span> '
             '<span class="highlight term-2">world</span> !</p></body></html>')
 
     def test_highlight_none(self):
-        self.assertEquals(
+        self.assertEqual(
             highlight(HTML_CONTENT, []), HTML_CONTENT)
 
     def test_highlight_multiple_in_one_markup(self):
-        self.assertEquals(
+        self.assertEqual(
             highlight(HTML_CONTENT.replace('!', 'hello'), ['hello']),
             '<html><body><p><span class="highlight term-1">Hello</span> '
             'world <span class="highlight term-1">hello</span></p>'
             '</body></html>')
 
     def test_dont_highlight_highlightings(self):
-        self.assertEquals(
+        self.assertEqual(
             highlight(HTML_CONTENT.replace('world', 'highlight'),
                       ['hello', 'highlight']),
             '<html><body><p><span class="highlight term-1">Hello</span> '
@@ -124,39 +288,469 @@ class TestHighlight(TestCase):
             '</body></html>')
 
     def test_dont_highlight_protected_markups(self):
-        self.assertEquals(
+        self.assertEqual(
             highlight(HTML_CONTENT.replace('world', '<pre>world</pre>'),
                       ['world']),
             '<html><body><p>Hello <pre>world</pre> !</p></body></html>')
 
+    def test_dont_highlight_nested_protected_markups(self):
+        content = HTML_CONTENT.replace('world', '<pre><b>world</b></pre>')
+        self.assertEqual(highlight(content, ['world']), content)
+
+    def test_dont_highlight_markups(self):
+        content = ('<!-- hello --><p title="hello">Hello &amp; '
+                   '<a href="/hello/">world</a></p>'
+                   '<script>var hello = "<p>hello</p>";</script>')
+        self.assertEqual(
+            highlight(content, ['hello', 'amp']),
+            '<!-- hello --><p title="hello">'
+            '<span class="highlight term-1">Hello</span> &amp; '
+            '<a href="/hello/">world</a></p>'
+            '<script>var hello = "<p>hello</p>";</script>')
+
+    def test_highlight_overlapping_terms(self):
+        self.assertEqual(
+            highlight(HTML_CONTENT, ['hell', 'hello', 'world']),
+            '<html><body><p><span class="highlight term-1">Hell</span>o '
+            '<span class="highlight term-3">world</span> !</p>'
+            '</body></html>')
+
+
+class TestHighlightFragment(TestCase):
+    """Tests of highlight_fragment function"""
+
+    def test_highlight_fragment(self):
+        self.assertEqual(
+            highlight_fragment('Fun & "coding"', ['coding', 'fun']),
+            '<span class="highlight term-2">Fun</span> &amp; &quot;'
+            '<span class="highlight term-1">coding</span>&quot;')
+        self.assertEqual(
+            highlight_fragment('Fun &amp; coding', ['amp'], False),
+            'Fun &<span class="highlight term-1">amp</span>; coding')
+        self.assertEqual(highlight_fragment("Fun'", []), 'Fun&#x27;')
+
+
+class TestHighlightBackends(TestCase):
+    """Tests of the highlighting backends"""
+    corpus = [
+        (HTML_CONTENT, ['Hello', 'world'],
+         '<html><body><p><span class="highlight term-1">Hello</span> '
+         '<span class="highlight term-2">world</span> !</p></body></html>'),
+        (HTML_CONTENT, ['HELLO', 'World'],
+         '<html><body><p><span class="highlight term-1">Hello</span> '
+         '<span class="highlight term-2">world</span> !</p></body></html>'),
+        (HTML_CONTENT.replace('!', 'hello'), ['hello'],
+         '<html><body><p><span class="highlight term-1">Hello</span> '
+         'world <span class="highlight term-1">hello</span></p>'
+         '</body></html>'),
+        (HTML_CONTENT.replace('world', 'highlight'), ['hello', 'highlight'],
+         '<html><body><p><span class="highlight term-1">Hello</span> '
+         '<span class="highlight term-2">highlight</span> !</p>'
+         '</body></html>'),
+        (HTML_CONTENT.replace('world', '<pre>world</pre>'), ['world'],
+         '<html><body><p>Hello <pre>world</pre> !</p></body></html>'),
+        ('<!-- hello --><p title="hello">Hello &amp; '
+         '<a href="/hello/">world</a></p>'
+         '<script>var hello = "<p>hello</p>";</script>', ['hello', 'amp'],
+         '<!-- hello --><p title="hello">'
+         '<span class="highlight term-1">Hello</span> &amp; '
+         '<a href="/hello/">world</a></p>'
+         '<script>var hello = "<p>hello</p>";</script>'),
+        ('Coding is fun :).', ['coding', 'fun'],
+         '<span class="highlight term-1">Coding</span> is '
+         '<span class="highlight term-2">fun</span> :).'),
+        ('\n<p>Coding is fun :).</p>\n', ['coding', 'fun'],
+         '\n<p><span class="highlight term-1">Coding</span> is '
+         '<span class="highlight term-2">fun</span> :).</p>\n'),
+        (' </div class="foo">', ['foo'], ' </div class="foo">'),
+    ]
+    # Markups and references left untouched by the tokenizers,
+    # but serialized by lxml
+    markup_corpus = [
+        ('AT&T foo', ['foo'],
+         'AT&T <span class="highlight term-1">foo</span>'),
+        ('&copy b foo', ['foo'],
+         '&copy b <span class="highlight term-1">foo</span>'),
+        ('x &#39 foo', ['foo'],
+         'x &#39 <span class="highlight term-1">foo</span>'),
+        ('<![CDATA[x]]> foo', ['foo'],
+         '<![CDATA[x]]> <span class="highlight term-1">foo</span>'),
+        ('</DIV > foo', ['foo'],
+         '</DIV > <span class="highlight term-1">foo</span>'),
+        ('<p>foo</p class="foo"> foo &amp', ['foo'],
+         '<p><span class="highlight term-1">foo</span></p class="foo"> '
+         '<span class="highlight term-1">foo</span> &amp'),
+    ]
+
+    def test_backends(self):
+        for parser in BACKENDS:
+            try:
+                backend = get_highlighter(parser)
+            except ImproperlyConfigured:
+                continue
+            for content, terms, result in self.corpus:
+                self.assertEqual(backend(terms).highlight(content), result)
+            self.assertTrue(backend(['ziltoid']).highlight(HTML_CONTENT)
+                            is HTML_CONTENT)
+
+    def test_tokenizers_markup(self):
+        for parser in ('regex', 'html.parser'):
+            backend = get_highlighter(parser)
+            for content, terms, result in self.markup_corpus:
+                self.assertEqual(backend(terms).highlight(content), result)
+
+    def test_tokenizers_lossless(self):
+        # Every token is output as it is, only the texts being wrapped
+        highlighting_re = re.compile(
+            '<span class="highlight term-\\d+">(.*?)</span>', re.S)
+        malformed = [
+            '<p\n class="foo">foo\n</p\n>foo', '<!-- foo', 'foo <!',
+            '<a href="foo', 'foo <', 'foo &', 'foo </', 'foo </p',
+            '<![if foo]>foo\n<![endif]>', '<?php foo ?>foo\n<? foo',
+            '<textarea>foo</textarea>foo\n<script>foo', '<!DOCTYPE foo',
+        ]
+        for parser in ('regex', 'html.parser'):
+            backend = get_highlighter(parser)
+            for content, terms, result in (
+                    self.corpus + self.markup_corpus +
+                    [(content, ['foo'], None) for content in malformed]):
+                output = backend(terms).highlight(content)
+                self.assertEqual(highlighting_re.sub('\\1', output),
+                                 content)
+                self.assertEqual(backend(['ziltoid']).highlight(content),
+                                 content)
+
+    def test_custom_backend(self):
+        self.assertEqual(get_highlighter('sekh.highlighting.Highlighter'),
+                         BACKENDS['regex'])
+
+
+class TestIndex(TestCase):
+    """Tests of the index of the words of the contents"""
+
+    def setUp(self):
+        self.index_cache = index_module.INDEX_CACHE
+        index_module.INDEX_CACHE = 'default'
+
+    def tearDown(self):
+        index_module.INDEX_CACHE = self.index_cache
+        caches['default'].clear()
+
+    def test_index(self):
+        index = Indexer().index(
+            '<p title="hello">Hello &amp; <b>world</b>s</p><pre>hello</pre>'
+            '<script>var hello;</script><!-- hello -->hello')
+        self.assertEqual(index.words, {
+            'Hello': array('I', [17]), 'world': array('I', [32]),
+            's': array('I', [41]), 'hello': array('I', [103])})
+
+    def test_highlight(self):
+        for content, terms, result in TestHighlightBackends.corpus:
+            self.assertEqual(Indexer().index(content).highlight(
+                content, terms), result)
+        self.assertTrue(Indexer().index(HTML_CONTENT).highlight(
+            HTML_CONTENT, ['ziltoid']) is HTML_CONTENT)
+
+    def test_serialize(self):
+        index = Indexer().index(HTML_CONTENT)
+        self.assertEqual(
+            TermIndex.deserialize(index.serialize()).words, index.words)
+        self.assertEqual(
+            TermIndex.deserialize(TermIndex().serialize()).words, {})
+
+    def test_highlight_indexed(self):
+        self.assertEqual(
+            index_module.highlight_indexed(HTML_CONTENT, ['hello']),
+            ('<html><body><p><span class="highlight term-1">Hello</span> '
+             'world !</p></body></html>', False))
+        key = index_module.get_index_key(HTML_CONTENT)
+        index = caches['default'].get(key)
+        self.assertEqual(index[0], 'Hello\nworld\n!')
+        caches['default'].set(key, ('world', b'', b''))
+        self.assertEqual(
+            index_module.highlight_indexed(HTML_CONTENT, ['hello']),
+            (HTML_CONTENT, False))
+
+    def test_highlight_indexed_budget(self):
+        self.assertEqual(
+            index_module.highlight_indexed(HTML_CONTENT, ['hello'], 0),
+            (HTML_CONTENT, True))
+        self.assertEqual(caches['default'].get(
+            index_module.get_index_key(HTML_CONTENT)), None)
+
+    def test_highlight_indexed_content(self):
+        offload_size = highlighting.OFFLOAD_SIZE
+        content = b'<p>caf\xe9 foo</p>'
+        result = b'<p>caf\xe9 <span class="highlight term-1">foo</span></p>'
+        try:
+            for highlighting.OFFLOAD_SIZE in (None, 10):
+                self.assertEqual(index_module.highlight_indexed_content(
+                    content, ['foo'], 'utf-8'), (result, False))
+        finally:
+            highlighting.OFFLOAD_SIZE = offload_size
+            highlighting.reset_process_pool()
+
+
+class TestHighlightCompressed(TestCase):
+    """Tests of highlight_compressed function"""
+
+    def test_highlight_compressed(self):
+        block_size = highlighting.DECOMPRESS_SIZE
+        highlighting.DECOMPRESS_SIZE = 7
+        content = ('<p>Caf\xe9 world</p>' * 50).encode('latin-1')
+        try:
+            output, degraded = highlight_compressed(
+                gzip.compress(content), ['caf\xe9'], 'latin-1', None, 'gzip')
+        finally:
+            highlighting.DECOMPRESS_SIZE = block_size
+        self.assertEqual(
+            gzip.decompress(output),
+            content.replace(b'Caf\xe9', b'<span class="highlight term-1">'
+                            b'Caf\xe9</span>'))
+        self.assertFalse(degraded)
+
+    def test_highlight_compressed_blocks(self):
+        block_size = highlighting.DECOMPRESS_SIZE
+        content = b'<p>Hello world</p>'
+        try:
+            for highlighting.DECOMPRESS_SIZE in range(1, len(content)):
+                output, degraded = highlight_compressed(
+                    gzip.compress(content), ['world'], 'utf-8', None,
+                    'gzip')
+                self.assertEqual(
+                    gzip.decompress(output),
+                    b'<p>Hello <span class="highlight term-1">world</span>'
+                    b'</p>')
+        finally:
+            highlighting.DECOMPRESS_SIZE = block_size
+
+    def test_highlight_compressed_degraded(self):
+        content = gzip.compress(b'<p>world</p>' * 500)
+        self.assertEqual(highlight_compressed(
+            content, ['ziltoid'], 'utf-8', None, 'gzip'), (b'', False))
+        self.assertEqual(highlight_compressed(
+            content, ['world'], 'utf-8', 0, 'gzip'), (b'', True))
+        self.assertEqual(highlight_compressed(
+            b'corrupted', ['world'], 'utf-8', None, 'gzip'), (b'', False))
+        self.assertRaises(
+            highlighting.ContentTooLarge, highlight_compressed,
+            content, ['world'], 'utf-8', None, 'gzip', 5999)
+        self.assertTrue(highlight_compressed(
+            content, ['world'], 'utf-8', None, 'gzip', 6000)[0])
+
+    @skipIf(highlighting.brotli is None, 'Brotli is not installed')
+    def test_brotli_decompressor(self):
+        content = b'<p>world</p>' * 100000
+        decompressor = highlighting.BrotliDecompressor()
+        blocks = [decompressor.decompress(
+            highlighting.brotli.compress(content), 65536)]
+        while len(blocks[-1]) >= 65536:
+            blocks.append(decompressor.decompress(b'', 65536))
+        self.assertTrue(len(blocks) > 1)
+        self.assertTrue(max(len(block) for block in blocks) < 2 * 65536)
+        self.assertEqual(b''.join(blocks), content)
+
+
+class TestHighlightStream(TestCase):
+    """Tests of highlight_stream function"""
+    content = ('<html><body><p title="hello">Hello <pre>world</pre> '
+               '&amp; world<!-- hello --></p></body></html>')
+
+    def test_highlight_stream(self):
+        result = highlight(self.content, ['hello', 'world'])
+        for size in range(1, len(self.content)):
+            chunks = [self.content[i:i + size]
+                      for i in range(0, len(self.content), size)]
+            self.assertEqual(
+                ''.join(highlight_stream(chunks, ['hello', 'world'])),
+                result)
+
+    def test_highlight_stream_unclosed(self):
+        skip_window = highlighting.SKIP_WINDOW
+        highlighting.SKIP_WINDOW = 50
+        try:
+            for markup in ('<!-- ', '<a title="', '<script>a < b '):
+                content = '<p>hello</p>%s%s' % (markup, 'hello world ' * 50)
+                chunks = [content[i:i + 10]
+                          for i in range(0, len(content), 10)]
+                highlighter = highlighting.Highlighter(['world'])
+                for chunk in chunks:
+                    highlighter.feed(chunk)
+                    self.assertTrue(len(highlighter.buffer) <= 60)
+                self.assertEqual(
+                    ''.join(highlight_stream(chunks, ['world'])),
+                    highlight(content, ['world']))
+        finally:
+            highlighting.SKIP_WINDOW = skip_window
+
+    def test_highlight_stream_utf16(self):
+        content = u'<p>caf\xe9 world</p>'.encode('utf-16')
+        self.assertEqual(
+            b''.join(highlight_stream([content[:8], content[8:]],
+                                      ['world'], 'utf-16')),
+            highlight(content.decode('utf-16'), ['world']).encode('utf-16'))
+
+    def test_highlight_stream_encoding(self):
+        content = self.content.replace('world', 'w\xf6rld').encode('utf-8')
+        chunks = [content[i:i + 3] for i in range(0, len(content), 3)]
+        self.assertEqual(
+            b''.join(highlight_stream(chunks, [u'w\xf6rld'], 'utf-8')),
+            highlight(content.decode('utf-8'),
+                      [u'w\xf6rld']).encode('utf-8'))
+
+
+def sleeping_highlighter(content, terms, charset, budget=None):
+    time.sleep(10)
+
+
+class TestHighlightContent(TestCase):
+    """Tests of highlight_content function"""
+    content = HTML_CONTENT.encode('utf-8')
+    highlighted_content = (
+        b'<html><body><p>Hello <span class="highlight term-1">world</span>'
+        b' !</p></body></html>')
+
+    def setUp(self):
+        self.offload_size = highlighting.OFFLOAD_SIZE
+        self.offload_timeout = highlighting.OFFLOAD_TIMEOUT
+
+    def tearDown(self):
+        highlighting.OFFLOAD_SIZE = self.offload_size
+        highlighting.OFFLOAD_TIMEOUT = self.offload_timeout
+        highlighting.reset_process_pool()
+
+    def test_highlight_content(self):
+        self.assertEqual(
+            highlight_content(self.content, ['world'], 'utf-8'),
+            (self.highlighted_content, False))
+        self.assertEqual(
+            highlight_content(self.content, ['ziltoid'], 'utf-8'),
+            (b'', False))
+        self.assertEqual(
+            highlight_content(self.content, ['world'], 'utf-8', 0),
+            (b'', True))
+
+    def test_highlight_content_misdeclared(self):
+        content = b'<p>caf\xe9 foo</p>'
+        self.assertEqual(
+            highlight_content(content, ['foo'], 'utf-8'),
+            (b'<p>caf\xe9 <span class="highlight term-1">foo</span></p>',
+             False))
+        for parser in BACKENDS:
+            try:
+                backend = get_highlighter(parser)
+            except ImproperlyConfigured:
+                continue
+            text = b'<p>foo caf\xe9 foo</p>'.decode(
+                'utf-8', 'surrogateescape')
+            output = backend(['foo']).highlight(text)
+            self.assertTrue(b'caf\xe9 ' in output.encode(
+                'utf-8', 'surrogateescape'))
+
+    def test_highlight_content_offload(self):
+        highlighting.OFFLOAD_SIZE = 10
+        self.assertEqual(
+            highlight_content(self.content, ['world'], 'utf-8'),
+            (self.highlighted_content, False))
+        highlighting.OFFLOAD_TIMEOUT = 0
+        self.assertEqual(
+            highlight_content(self.content, ['world'], 'utf-8'),
+            (b'', True))
+
+    def test_highlight_content_offload_stuck(self):
+        highlighting.OFFLOAD_SIZE = 10
+        highlighting.OFFLOAD_TIMEOUT = 0.1
+        pool = highlighting.get_process_pool()
+        processes = list(pool._processes.values())
+        other_page = pool.submit(sleeping_highlighter, self.content,
+                                 ['world'], 'utf-8')
+        self.assertEqual(
+            highlight_content(self.content, ['world'], 'utf-8', None,
+                              sleeping_highlighter),
+            (b'', True))
+        self.assertTrue(highlighting.process_pool is None)
+        for process in processes:
+            process.join(5)
+            self.assertFalse(process.is_alive())
+        # The pages of the other requests are lost too
+        self.assertRaises(BrokenProcessPool, other_page.result, 5)
+        self.assertEqual(
+            highlight_content(self.content, ['world'], 'utf-8'),
+            (self.highlighted_content, False))
+        self.assertFalse(highlighting.process_pool is pool)
+
+    def test_process_context(self):
+        self.assertTrue(highlighting.get_process_context().get_start_method()
+                        in ('forkserver', 'spawn'))
+
+
+class TestHighlightBudget(TestCase):
+    """Tests of the time budget of the highlighting"""
+
+    def test_expired(self):
+        for parser in BACKENDS:
+            try:
+                backend = get_highlighter(parser)
+            except ImproperlyConfigured:
+                continue
+            highlighter = backend(['world'], 0)
+            self.assertEqual(highlighter.highlight(HTML_CONTENT),
+                             HTML_CONTENT)
+            self.assertTrue(highlighter.degraded)
+
+    def test_partially_highlighted(self):
+        class ExpiringHighlighter(Highlighter):
+            def expired(self):
+                self.degraded = self.updated
+                return self.degraded
+
+        highlighter = ExpiringHighlighter(['world'])
+        self.assertEqual(
+            highlighter.highlight('<p>World</p><p>world</p>'),
+            '<p><span class="highlight term-1">World</span></p>'
+            '<p>world</p>')
+        self.assertTrue(highlighter.degraded)
+
 
 class TestGenerateTermPositions(TestCase):
     """Test of generate_term_positions function"""
     content = ('Il etait une fois dans un pays merveilleux, '
                'un petit garcon nomme Darwin').split()
 
+    def generate_term_positions(self, terms):
+        return [list(x) for x in
+                generate_term_positions(self.content, terms)]
+
     def test_generate_term_positions(self):
-        self.assertEquals(
-            generate_term_positions(self.content, ['garcon']),
+        self.assertEqual(
+            self.generate_term_positions(['garcon']),
             [[10]])
-        self.assertEquals(
-            generate_term_positions(self.content, ['toto']),
+        self.assertEqual(
+            self.generate_term_positions(['toto']),
             [])
 
     def test_generate_term_positions_multi(self):
-        self.assertEquals(
-            generate_term_positions(self.content, ['un', 'garcon']),
-            [[10], [2, 5, 8]])
-        self.assertEquals(
-            generate_term_positions(self.content, ['garcon', 'un']),
+        self.assertEqual(
+            self.generate_term_positions(['un', 'garcon']),
+            [[2, 5, 8], [10]])
+        self.assertEqual(
+            self.generate_term_positions(['garcon', 'un']),
             [[10], [2, 5, 8]])
-        self.assertEquals(
-            generate_term_positions(self.content, ['garcon', 'toto', 'un']),
+        self.assertEqual(
+            self.generate_term_positions(['garcon', 'toto', 'un']),
             [[10], [2, 5, 8]])
 
+    def test_generate_term_positions_prefix(self):
+        self.assertEqual(
+            self.generate_term_positions(['u', 'un']),
+            [[2, 5, 8]])
+        self.assertEqual(
+            self.generate_term_positions(['une', 'un', 'pet']),
+            [[2], [5, 8], [9]])
+
     def test_generate_term_positions_case(self):
-        self.assertEquals(
-            generate_term_positions(self.content, ['UN', 'gARcon']),
+        self.assertEqual(
+            self.generate_term_positions(['UN', 'gARcon']),
             [[2, 5, 8], [10]])
 
 
@@ -164,28 +758,81 @@ class TestShortestTermSpan(TestCase):
     """Test of shortest_term_span function"""
 
     def test_shortest_term_span(self):
-        self.assertEquals(
+        self.assertEqual(
             shortest_term_span([[0, 5, 10, 15],
                                 [1, 3, 6, 9],
                                 [4, 8, 16, 21]]),
             [3, 4, 5])
-        self.assertEquals(
+        self.assertEqual(
             shortest_term_span([[0, 5],
                                 [1, 3, 9],
                                 [8, 16, 21, 22]]),
             [5, 8, 9])
-        self.assertEquals(
+        self.assertEqual(
             shortest_term_span([[0, 1],
                                 [4, 5],
                                 [2, 3]]),
             [1, 2, 4])
 
+    def reference_term_span(self, positions):
+        indices = [0] * len(positions)
+        min_window = window = get_window(positions, indices)
+        while True:
+            min_index = get_min_index(positions, window)
+            if min_index is None:
+                break
+            indices[min_index] += 1
+            window = get_window(positions, indices)
+            if list_range(min_window) > list_range(window):
+                min_window = window
+            if list_range(min_window) == len(positions):
+                break
+        return sorted(min_window)
+
+    def test_shortest_term_span_shared(self):
+        self.assertEqual(
+            shortest_term_span([[2], [2, 7], [1, 2, 9]]),
+            [2, 2, 2])
+        self.assertEqual(
+            shortest_term_span([[0, 6], [4], [4, 5]]),
+            [4, 4, 6])
+
+    def test_shortest_term_span_random(self):
+        generator = random.Random(42)
+        for i in range(2000):
+            size = generator.randint(1, 30)
+            positions = [
+                sorted(generator.sample(range(size), generator.randint(
+                    1, min(size, generator.choice([1, 2, 6])))))
+                for term in range(generator.randint(1, 5))]
+            self.assertEqual(shortest_term_span(positions),
+                             self.reference_term_span(positions),
+                             positions)
+
+
+class TestIterWords(TestCase):
+    """Test of iter_words function"""
+
+    def test_iter_words(self):
+        content = ' Lorem  ipsum\tdolor\nsit\xa0amet, consectetur '
+        self.assertEqual(list(iter_words(content)), content.split())
+        self.assertEqual(list(iter_words('')), [])
+
+    def test_iter_words_blocks(self):
+        block_size = excerpt_module.WORDS_BLOCK_SIZE
+        excerpt_module.WORDS_BLOCK_SIZE = 4
+        content = 'Lorem ipsum  dolor sit amet,\n\nconsectetur'
+        try:
+            self.assertEqual(list(iter_words(content)), content.split())
+        finally:
+            excerpt_module.WORDS_BLOCK_SIZE = block_size
+
 
 class TestShortenExcerpt(TestCase):
     """Test of shorten_excerpt function"""
 
     def test_shorten_excerpt(self):
-        self.assertEquals(
+        self.assertEqual(
             shorten_excerpt(
                 'test blah blah blah blah blah blah case',
                 'test case'),
@@ -204,24 +851,24 @@ class TestExcerpt(TestCase):
         'Praesent vitae viverra purus.')
 
     def test_excerpt(self):
-        self.assertEquals(
+        self.assertEqual(
             excerpt(self.content, ['lacus'], 40),
             'et aliquet. Sed sit amet ultricies libero. Etiam facilisis, '
             'lectus ut tristique rutrum, leo libero elementum eros, sed '
             'lobortis urna lacus sit amet velit. Quisque ut leo eu dolor '
             'aliquet eleifend mattis et urna. Praesent vitae viverra purus.')
-        self.assertEquals(
+        self.assertEqual(
             excerpt(self.content, ['lacus'], 10),
             'elementum eros, sed lobortis urna lacus sit amet velit. '
             'Quisque ut')
-        self.assertEquals(
+        self.assertEqual(
             excerpt(self.content, ['aliquet'], 40),
             'consectetur adipiscing elit. In in nunc eros! Suspendisse a '
             'feugiat eros, et pharetra nisl ? Cras pulvinar varius enim '
             'et aliquet. Sed sit amet ultricies libero. Etiam facilisis, '
             'lectus ut tristique rutrum, leo libero elementum eros, sed '
             'lobortis urna lacus sit')
-        self.assertEquals(
+        self.assertEqual(
             excerpt(self.content, ['aliquet'], 10),
             'Cras pulvinar varius enim et aliquet. Sed sit amet '
             'ultricies libero.')
@@ -236,24 +883,24 @@ class TestExcerpt(TestCase):
             'ut tristique rutrum, leo libero elementum ... lacus sit amet '
             'velit. Quisque ut ... aliquet eleifend mattis et urna. '
             'Praesent ...')
-        self.assertEquals(
+        self.assertEqual(
             excerpt(self.content, ['aliquet', 'lacus'], 40), result)
-        self.assertEquals(
+        self.assertEqual(
             excerpt(self.content, ['lacus', 'aliquet'], 40), result)
-        self.assertEquals(
+        self.assertEqual(
             excerpt(self.content, ['aliquet', 'lacus'], 20),
             result_compressed)
 
     def test_excerpt_multi_terms_extra_long(self):
-        self.assertEquals(
+        self.assertEqual(
             excerpt(self.content, ['lorem', 'purus'], 40),
             'Lorem ipsum dolor sit amet, consectetur ... purus.')
-        self.assertEquals(
+        self.assertEqual(
             excerpt(self.content, ['lorem', 'purus'], 10),
             'Lorem ipsum dolor sit amet, consectetur ... purus.')
 
     def test_excerpt_case(self):
-        self.assertEquals(
+        self.assertEqual(
             excerpt(self.content, ['LACUS'], 40),
             'et aliquet. Sed sit amet ultricies libero. Etiam facilisis, '
             'lectus ut tristique rutrum, leo libero elementum eros, sed '
@@ -261,32 +908,197 @@ class TestExcerpt(TestCase):
             'aliquet eleifend mattis et urna. Praesent vitae viverra purus.')
 
     def test_excerpt_not_present(self):
-        self.assertEquals(
+        self.assertEqual(
             excerpt(self.content, ['toto'], 40),
             'Lorem ipsum dolor sit amet, consectetur adipiscing elit. '
             'In in nunc eros! Suspendisse a feugiat eros, et pharetra '
             'nisl ? Cras pulvinar varius enim et aliquet. Sed sit amet '
             'ultricies libero. Etiam facilisis, lectus ut tristique '
             'rutrum, leo libero elementum')
-        self.assertEquals(
+        self.assertEqual(
             excerpt(self.content, ['toto'], 10),
             'Lorem ipsum dolor sit amet, consectetur adipiscing elit. '
             'In in')
 
+    def test_excerpt_matches_bounded(self):
+        matches_size = excerpt_module.MATCHES_SIZE
+        excerpt_module.MATCHES_SIZE = 3
+        matches = {}
+        try:
+            self.assertEqual(
+                excerpt(self.content, ['lacus'], 10, matches),
+                'elementum eros, sed lobortis urna lacus sit amet velit. '
+                'Quisque ut')
+        finally:
+            excerpt_module.MATCHES_SIZE = matches_size
+        self.assertEqual(len(matches), 3)
+
     def test_excerpt_none(self):
-        self.assertEquals(
+        self.assertEqual(
             excerpt(self.content, [], 40),
             'Lorem ipsum dolor sit amet, consectetur adipiscing elit. '
             'In in nunc eros! Suspendisse a feugiat eros, et pharetra '
             'nisl ? Cras pulvinar varius enim et aliquet. Sed sit amet '
             'ultricies libero. Etiam facilisis, lectus ut tristique '
             'rutrum, leo libero elementum')
-        self.assertEquals(
+        self.assertEqual(
             excerpt(self.content, [], 10),
             'Lorem ipsum dolor sit amet, consectetur adipiscing elit. '
             'In in')
 
 
+class TestExcerptHighlight(TestCase):
+    """Test of excerpt_highlight function"""
+    content = ('Lorem ipsum <dolor> sit amet, consectetur adipiscing elit. '
+               'In in nunc eros! Suspendisse a "feugiat" eros & pharetra.')
+
+    def test_excerpt_highlight(self):
+        self.assertEqual(
+            excerpt_highlight(self.content, ['ipsum', 'eros'], 12),
+            'Lorem <span class="highlight term-1">ipsum</span> &lt;dolor&gt; '
+            'sit amet, consectetur adipiscing ... '
+            '<span class="highlight term-2">eros</span>! Suspendisse a '
+            '&quot;feugiat&quot; <span class="highlight term-2">eros</span> '
+            '&amp; pharetra.')
+
+    def test_excerpt_highlight_same_as_highlight(self):
+        for terms in (['ipsum'], ['eros', 'elit'], ['toto'], ['in', 'a']):
+            for max_length in (4, 10, 40):
+                self.assertEqual(
+                    excerpt_highlight(self.content, terms, max_length),
+                    highlight(escape(excerpt(self.content, terms,
+                                             max_length)), terms))
+
+
+@skipIf(excerpt_module.numpy is None, 'NumPy is not installed')
+class TestExcerptNumpy(TestExcerpt):
+    """Test of excerpt function vectorised with NumPy"""
+
+    def setUp(self):
+        self.numpy_threshold = excerpt_module.EXCERPT_NUMPY_THRESHOLD
+        excerpt_module.EXCERPT_NUMPY_THRESHOLD = 0
+
+    def tearDown(self):
+        excerpt_module.EXCERPT_NUMPY_THRESHOLD = self.numpy_threshold
+
+    def test_excerpt_same_as_python(self):
+        content = ' '.join(['blah', 'test', 'case', 'blah', 'blah', 'case',
+                            'blah', 'other', 'test', 'blah'] * 20)
+        for terms in (['test', 'case'], ['case', 'other'], ['other']):
+            for max_length in (3, 10, 40):
+                vectorised = excerpt(content, terms, max_length)
+                excerpt_module.EXCERPT_NUMPY_THRESHOLD = None
+                self.assertEqual(
+                    vectorised, excerpt(content, terms, max_length))
+                excerpt_module.EXCERPT_NUMPY_THRESHOLD = 0
+
+
+class TestExcerptMany(TestCase):
+    """Test of excerpt_many function"""
+    documents = ['Hello world !', 'The world is a vampire',
+                 'Nothing to see', 'Wonderful World, beautiful people']
+
+    def test_excerpt_many(self):
+        self.assertEqual(
+            list(excerpt_many(self.documents, ['world', 'vampire'], 3)),
+            [excerpt(document, ['world', 'vampire'], 3)
+             for document in self.documents])
+
+    def test_excerpt_many_matches_bounded(self):
+        results = [excerpt(document, ['world'], 3)
+                   for document in self.documents]
+        memos = []
+
+        def shared_excerpt(document, terms, max_length, matches):
+            memos.append(matches)
+            return excerpt(document, terms, max_length, matches)
+
+        matches_size = excerpt_module.MATCHES_SIZE
+        excerpt_module.MATCHES_SIZE = 3
+        excerpt_module.excerpt = shared_excerpt
+        try:
+            self.assertEqual(
+                list(excerpt_many(self.documents, ['world'], 3)), results)
+        finally:
+            excerpt_module.MATCHES_SIZE = matches_size
+            excerpt_module.excerpt = excerpt
+        self.assertEqual(len(memos), len(self.documents))
+        self.assertTrue(all(memo is memos[0] for memo in memos))
+        self.assertEqual(len(memos[0]), 3)
+
+    def test_excerpt_many_executor(self):
+        with ThreadPoolExecutor(2) as executor:
+            self.assertEqual(
+                list(excerpt_many(self.documents, ['world'], 3, executor)),
+                [excerpt(document, ['world'], 3)
+                 for document in self.documents])
+
+
+class TestBaseSearchReferrer(TestCase):
+    """Tests of the search engines detection"""
+
+    def test_parse_search(self):
+        referrer = BaseSearchReferrer()
+        self.assertEqual(
+            referrer.parse_search('http://www.google.co.uk/?q=Django+Sekh'),
+            ('Google', 'www.google.co.uk', ['django', 'sekh']))
+        self.assertEqual(
+            referrer.parse_search('http://BING.com:8080/?q=django'),
+            ('Bing', 'BING.com:8080', ['django']))
+        self.assertEqual(
+            referrer.parse_search('http://fr.search.yahoo.com/?p=django'),
+            ('Yahoo', 'fr.search.yahoo.com', ['django']))
+        self.assertEqual(
+            referrer.parse_search('http://www.google.com/?p=django'),
+            (None, 'www.google.com', []))
+        self.assertEqual(
+            referrer.parse_search('http://www.googlemail.com/?q=django'),
+            (None, 'www.googlemail.com', []))
+        self.assertEqual(referrer.parse_search(None), (None, None, []))
+
+    def test_parse_search_engines(self):
+        referrer = BaseSearchReferrer()
+        self.assertEqual(
+            referrer.parse_search('https://duckduckgo.com/?q=django'),
+            ('DuckDuckGo', 'duckduckgo.com', ['django']))
+        self.assertEqual(
+            referrer.parse_search('https://yandex.ru/search/?text=django'),
+            ('Yandex', 'yandex.ru', ['django']))
+        self.assertEqual(
+            referrer.parse_search('https://ya.ru/search/?text=django'),
+            ('Yandex', 'ya.ru', ['django']))
+        self.assertEqual(
+            referrer.parse_search('https://yandex.ru:port/?text=django'),
+            (None, 'yandex.ru:port', []))
+
+    def test_custom_search_engines(self):
+        class SearchReferrer(BaseSearchReferrer):
+            SEARCH_PARAMS = {'Example': ('s', 'search.example', 'ex')}
+
+        referrer = SearchReferrer()
+        self.assertEqual(
+            referrer.parse_search('http://www.search.example.org/?s=a'),
+            ('Example', 'www.search.example.org', ['a']))
+        self.assertEqual(
+            referrer.parse_search('http://ex.co.uk/?s=a'),
+            ('Example', 'ex.co.uk', ['a']))
+        self.assertEqual(
+            referrer.parse_search('http://example.org/?s=a'),
+            (None, 'example.org', []))
+        self.assertEqual(
+            referrer.parse_search('http://www.google.com/?q=a'),
+            (None, 'www.google.com', []))
+
+    def test_network_cache(self):
+        referrer = BaseSearchReferrer()
+        self.assertEqual(referrer.get_search_engine('www.baidu.com'),
+                         ('Baidu', 'wd'))
+        self.assertEqual(
+            middleware.networks_cache.get(
+                (BaseSearchReferrer, 'www.baidu.com')),
+            ('Baidu', 'wd'))
+
+
 class TestKeywordsHighlightingMiddleware(TestCase):
     """Tests of the Sekh middleware"""
 
@@ -301,30 +1113,30 @@ class TestKeywordsHighlightingMiddleware(TestCase):
         response = KeywordsHighlightingMiddleware().process_response(
             self._get_request(referer='http://toto.com/?q=Hello'),
             HttpResponse(HTML_CONTENT))
-        self.assertEquals(response.content.decode('utf-8'), HTML_CONTENT)
+        self.assertEqual(response.content.decode('utf-8'), HTML_CONTENT)
 
         response = KeywordsHighlightingMiddleware().process_response(
             self._get_request(referer='http://www.google.com/?q=world'),
             HttpResponse(HTML_CONTENT))
-        self.assertEquals(response.content.decode('utf-8'),
-                          '<html><body><p>Hello <span class="highlight '
-                          'term-1">world</span> !</p></body></html>')
+        self.assertEqual(response.content.decode('utf-8'),
+                         '<html><body><p>Hello <span class="highlight '
+                         'term-1">world</span> !</p></body></html>')
 
     def test_get(self):
         response = KeywordsHighlightingMiddleware().process_response(
             self._get_request(),
             HttpResponse(HTML_CONTENT))
-        self.assertEquals(response.content.decode('utf-8'), HTML_CONTENT)
+        self.assertEqual(response.content.decode('utf-8'), HTML_CONTENT)
 
         response = KeywordsHighlightingMiddleware().process_response(
             self._get_request({'highlight': 'ziltoid'}),
             HttpResponse(HTML_CONTENT))
-        self.assertEquals(response.content.decode('utf-8'), HTML_CONTENT)
+        self.assertEqual(response.content.decode('utf-8'), HTML_CONTENT)
 
         response = KeywordsHighlightingMiddleware().process_response(
             self._get_request({'highlight': 'Hello world'}),
             HttpResponse(HTML_CONTENT))
-        self.assertEquals(
+        self.assertEqual(
             response.content.decode('utf-8'),
             '<html><body><p><span class="highlight term-1">Hello</span> '
             '<span class="highlight term-2">world</span> !</p></body></html>')
@@ -334,16 +1146,354 @@ class TestKeywordsHighlightingMiddleware(TestCase):
                                'hl': 'World',
                                'q': 'Hello'}),
             HttpResponse(HTML_CONTENT))
-        self.assertEquals(
+        self.assertEqual(
             response.content.decode('utf-8'),
             '<html><body><p><span class="highlight term-1">Hello</span> '
             '<span class="highlight term-2">world</span> !</p></body></html>')
 
+    def test_streaming(self):
+        response = KeywordsHighlightingMiddleware().process_response(
+            self._get_request({'highlight': 'Hello world'}),
+            StreamingHttpResponse([HTML_CONTENT[:18], HTML_CONTENT[18:]]))
+        self.assertEqual(
+            b''.join(response.streaming_content).decode('utf-8'),
+            '<html><body><p><span class="highlight term-1">Hello</span> '
+            '<span class="highlight term-2">world</span> !</p></body></html>')
+
+    def test_streaming_misdeclared_charset(self):
+        for query, content in (
+                ('zzz', b'<p>caf\xe9</p>'),
+                ('caf', b'<p><span class="highlight term-1">caf</span>'
+                        b'\xe9</p>')):
+            response = KeywordsHighlightingMiddleware().process_response(
+                self._get_request({'q': query}),
+                StreamingHttpResponse([b'<p>caf', b'\xe9</p>']))
+            self.assertEqual(b''.join(response.streaming_content), content)
+
+    def test_compressed(self):
+        highlighted = ('<html><body><p><span class="highlight term-1">Hello'
+                       '</span> world !</p></body></html>').encode('utf-8')
+        codings = [('gzip', gzip.compress, gzip.decompress),
+                   ('deflate', zlib.compress, zlib.decompress)]
+        if highlighting.brotli is not None:
+            codings.append(('br', highlighting.brotli.compress,
+                            highlighting.brotli.decompress))
+        for coding, compress, decompress in codings:
+            response = HttpResponse(compress(HTML_CONTENT.encode('utf-8')))
+            response['Content-Encoding'] = coding
+            response['Content-Length'] = len(response.content)
+            response = KeywordsHighlightingMiddleware().process_response(
+                self._get_request({'highlight': 'Hello'}), response)
+            self.assertEqual(decompress(response.content), highlighted)
+            self.assertEqual(response['Content-Length'],
+                             str(len(response.content)))
+
+    def test_compressed_streaming(self):
+        content = gzip.compress(HTML_CONTENT.encode('utf-8'))
+        response = StreamingHttpResponse([content[:10], content[10:]])
+        response['Content-Encoding'] = 'GZIP'
+        response = KeywordsHighlightingMiddleware().process_response(
+            self._get_request({'highlight': 'Hello'}), response)
+        self.assertEqual(
+            gzip.decompress(b''.join(response.streaming_content)),
+            b'<html><body><p><span class="highlight term-1">Hello</span> '
+            b'world !</p></body></html>')
+
+    def test_compressed_unsupported(self):
+        for coding, content in (('compress', b'compressed'),
+                                ('gzip', b'corrupted'),
+                                ('gzip', gzip.compress(b'<p>Hi</p>'))):
+            response = HttpResponse(content)
+            response['Content-Encoding'] = coding
+            response = KeywordsHighlightingMiddleware().process_response(
+                self._get_request({'highlight': 'Hello'}), response)
+            self.assertEqual(response.content, content)
+
+    def test_not_highlightable(self):
+        request = self._get_request({'highlight': 'Hello'})
+        responses = [HttpResponse(HTML_CONTENT, status=404),
+                     HttpResponse(HTML_CONTENT,
+                                  content_type='application/json'),
+                     HttpResponse(HTML_CONTENT), HttpResponse('')]
+        del responses[2]['Content-Type']
+        responses[3]['Content-Length'] = '0'
+        for response in responses:
+            content = response.content
+            response = KeywordsHighlightingMiddleware().process_response(
+                request, response)
+            self.assertEqual(response.content, content)
+
+    def test_request_terms(self):
+        highlighter = KeywordsHighlightingMiddleware(
+            lambda request: HttpResponse(HTML_CONTENT))
+        request = self._get_request({'highlight': 'Hello'})
+        request.method = 'HEAD'
+        self.assertEqual(highlighter(request).content,
+                         HTML_CONTENT.encode('utf-8'))
+        self.assertEqual(request._highlight_terms, [])
+
+        excluded_paths = middleware.EXCLUDED_PATHS
+        middleware.EXCLUDED_PATHS = ['/api/']
+        try:
+            request = self._get_request({'highlight': 'Hello'})
+            request.path = '/api/pages/'
+            self.assertEqual(highlighter.get_request_terms(request), [])
+            request.path = '/pages/'
+            self.assertEqual(highlighter.get_request_terms(request),
+                             ['Hello'])
+        finally:
+            middleware.EXCLUDED_PATHS = excluded_paths
+
+    def test_no_highlight(self):
+        @no_highlight
+        def view(request):
+            return HttpResponse(HTML_CONTENT)
+
+        highlighter = KeywordsHighlightingMiddleware()
+        request = self._get_request({'highlight': 'Hello'})
+        highlighter.process_request(request)
+        self.assertEqual(request._highlight_terms, ['Hello'])
+        highlighter.process_view(request, view, (), {})
+        response = highlighter.process_response(request, view(request))
+        self.assertEqual(response.content, HTML_CONTENT.encode('utf-8'))
+        self.assertEqual(view.__name__, 'view')
+
+    def test_misdeclared_charset(self):
+        response = KeywordsHighlightingMiddleware().process_response(
+            self._get_request({'q': 'foo'}),
+            HttpResponse(b'<p>caf\xe9 foo</p>'))
+        self.assertEqual(
+            response.content,
+            b'<p>caf\xe9 <span class="highlight term-1">foo</span></p>')
+        response = KeywordsHighlightingMiddleware().process_response(
+            self._get_request({'q': '\xe9t\xe9'}),
+            HttpResponse(b'<p>caf\xe9 foo</p>'))
+        self.assertEqual(response.content, b'<p>caf\xe9 foo</p>')
+
+    def test_prefilter(self):
+        content = '<p>\xc9t\xe9 world</p>'
+        response = KeywordsHighlightingMiddleware().process_response(
+            self._get_request({'highlight': 'WORLD'}),
+            HttpResponse(content))
+        self.assertEqual(response.content.decode('utf-8'),
+                         '<p>\xc9t\xe9 <span class="highlight term-1">'
+                         'world</span></p>')
+        response = KeywordsHighlightingMiddleware().process_response(
+            self._get_request({'highlight': '\xe9t\xe9'}),
+            HttpResponse(content))
+        self.assertEqual(response.content.decode('utf-8'),
+                         '<p><span class="highlight term-1">\xc9t\xe9'
+                         '</span> world</p>')
+        response = KeywordsHighlightingMiddleware().process_response(
+            self._get_request({'highlight': 'ziltoid \xe9t\xe0'}),
+            HttpResponse(content))
+        self.assertEqual(response.content.decode('utf-8'), content)
+
     def test_non_html(self):
         response = KeywordsHighlightingMiddleware().process_response(
             self._get_request({'highlight': 'Hello world'}),
             HttpResponse(HTML_CONTENT, content_type='text/xml'))
-        self.assertEquals(response.content.decode('utf-8'), HTML_CONTENT)
+        self.assertEqual(response.content.decode('utf-8'), HTML_CONTENT)
+
+
+class TestKeywordsHighlightingMiddlewareNewStyle(TestCase):
+    """Tests of the Sekh middleware as a new-style middleware"""
+    highlighted_content = (
+        '<html><body><p><span class="highlight term-1">Hello</span> '
+        '<span class="highlight term-2">world</span> !</p></body></html>')
+
+    def setUp(self):
+        self.request = HttpRequest()
+        self.request.GET = {'hl': 'Hello world'}
+
+    def test_sync(self):
+        middleware = KeywordsHighlightingMiddleware(
+            lambda request: HttpResponse(HTML_CONTENT))
+        self.assertFalse(iscoroutinefunction(middleware))
+        response = middleware(self.request)
+        self.assertEqual(response.content.decode('utf-8'),
+                         self.highlighted_content)
+
+    async def test_async(self):
+        async def get_response(request):
+            return HttpResponse(HTML_CONTENT)
+
+        middleware = KeywordsHighlightingMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        response = await middleware(self.request)
+        self.assertEqual(response.content.decode('utf-8'),
+                         self.highlighted_content)
+
+    async def test_async_streaming(self):
+        async def chunks():
+            yield HTML_CONTENT[:18]
+            yield HTML_CONTENT[18:]
+
+        async def get_response(request):
+            return StreamingHttpResponse(chunks())
+
+        response = await KeywordsHighlightingMiddleware(get_response)(
+            self.request)
+        self.assertTrue(response.is_async)
+        content = b''.join([chunk async for chunk
+                            in response.streaming_content])
+        self.assertEqual(content.decode('utf-8'), self.highlighted_content)
+
+    async def test_async_streaming_process(self):
+        async def chunks():
+            yield HTML_CONTENT
+
+        executor = highlighting.EXECUTOR
+        highlighting.EXECUTOR = 'process'
+        try:
+            content = ''.join([chunk async for chunk in
+                               highlighting.ahighlight_stream(
+                                   chunks(), ['world'])])
+        finally:
+            highlighting.EXECUTOR = executor
+        self.assertEqual(content, highlight(HTML_CONTENT, ['world']))
+
+
+class TestKeywordsHighlightingMiddlewareDegraded(TestCase):
+    """Tests of the degradation of the Sekh middleware"""
+
+    def setUp(self):
+        self.max_size = middleware.MAX_SIZE
+        self.time_budget = middleware.TIME_BUDGET
+        self.request = HttpRequest()
+        self.request.GET = {'hl': 'world'}
+        self.reasons = []
+        highlight_degraded.connect(self.receive_degraded)
+
+    def tearDown(self):
+        middleware.MAX_SIZE = self.max_size
+        middleware.TIME_BUDGET = self.time_budget
+        highlight_degraded.disconnect(self.receive_degraded)
+
+    def receive_degraded(self, sender, request, response, reason, **kwargs):
+        self.reasons.append(reason)
+
+    def test_max_size(self):
+        middleware.MAX_SIZE = 10
+        response = KeywordsHighlightingMiddleware().process_response(
+            self.request, HttpResponse(HTML_CONTENT))
+        self.assertEqual(response.content.decode('utf-8'), HTML_CONTENT)
+        self.assertEqual(response['X-Highlight-Degraded'], 'size')
+        self.assertEqual(self.reasons, ['size'])
+
+    def test_time_budget(self):
+        middleware.TIME_BUDGET = 0
+        response = KeywordsHighlightingMiddleware().process_response(
+            self.request, HttpResponse(HTML_CONTENT))
+        self.assertEqual(response.content.decode('utf-8'), HTML_CONTENT)
+        self.assertEqual(response['X-Highlight-Degraded'], 'timeout')
+        self.assertEqual(self.reasons, ['timeout'])
+
+    def test_compressed(self):
+        content = gzip.compress(HTML_CONTENT.encode('utf-8') * 100)
+        for max_size, time_budget, reason in ((100, None, 'size'),
+                                              (None, 0, 'timeout')):
+            middleware.MAX_SIZE = max_size
+            middleware.TIME_BUDGET = time_budget
+            response = HttpResponse(content)
+            response['Content-Encoding'] = 'gzip'
+            response = KeywordsHighlightingMiddleware().process_response(
+                self.request, response)
+            self.assertEqual(response.content, content)
+            self.assertEqual(response['X-Highlight-Degraded'], reason)
+        self.assertEqual(self.reasons, ['size', 'timeout'])
+
+    def test_not_degraded(self):
+        middleware.MAX_SIZE = 1000
+        middleware.TIME_BUDGET = 60
+        response = KeywordsHighlightingMiddleware().process_response(
+            self.request, HttpResponse(HTML_CONTENT))
+        self.assertNotEqual(response.content.decode('utf-8'), HTML_CONTENT)
+        self.assertFalse(response.has_header('X-Highlight-Degraded'))
+        self.assertEqual(self.reasons, [])
+
+
+class TestMetrics(TestCase):
+    """Tests of the metrics of Sekh"""
+
+    def setUp(self):
+        self.measures = []
+        measured.connect(self.receive_measured)
+
+    def tearDown(self):
+        measured.disconnect(self.receive_measured)
+
+    def receive_measured(self, sender, name, duration, metrics, **kwargs):
+        self.measures.append((name, metrics))
+
+    def test_measured(self):
+        request = HttpRequest()
+        request.GET = {'hl': 'world'}
+        request.META['HTTP_REFERER'] = 'http://www.google.com/?q=hello'
+        response = KeywordsHighlightingMiddleware().process_response(
+            request, HttpResponse(HTML_CONTENT))
+        self.assertEqual(self.measures, [
+            ('parse_search', {'terms': 1, 'outcome': 'Google'}),
+            ('highlight', {'size': 46, 'terms': 2, 'matches': 2,
+                           'added': 76, 'outcome': 'highlighted'}),
+            ('middleware', {'size': 46, 'terms': 2, 'added': 76,
+                            'outcome': 'highlighted'})])
+        self.assertTrue(response['Server-Timing'].startswith('sekh;dur='))
+        self.assertTrue(response['Server-Timing'].endswith(
+            ';desc="highlighted"'))
+
+    def test_measured_excerpt(self):
+        excerpt('Hello world !', ['world', 'ziltoid'])
+        self.assertEqual(self.measures, [
+            ('excerpt', {'size': 13, 'terms': 2, 'matches': 1,
+                         'outcome': 'excerpted'})])
+
+    def test_statsd_sink(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+        sink = StatsdSink(listener.getsockname(), 'prefix')
+        sink('highlight', 0.0015, {'size': 46, 'outcome': 'no-match'})
+        self.assertEqual(listener.recv(1024),
+                         b'prefix.highlight.time:1.500|ms\n'
+                         b'prefix.highlight.no-match:1|c\n'
+                         b'prefix.highlight.size:46|h')
+        listener.close()
+
+
+class TestKeywordsHighlightingMiddlewareCache(TestCase):
+    """Tests of the cache of the Sekh middleware"""
+
+    def setUp(self):
+        self.cache = middleware.CACHE
+        middleware.CACHE = 'default'
+        self.middleware = KeywordsHighlightingMiddleware()
+        self.request = HttpRequest()
+        self.request.GET = {'hl': 'world'}
+
+    def tearDown(self):
+        middleware.CACHE = self.cache
+        caches['default'].clear()
+
+    def test_cache(self):
+        response = HttpResponse(HTML_CONTENT)
+        key = self.middleware.get_cache_key(
+            response.content, ['world'], 'utf-8')
+        caches['default'].set(key, b'Cached')
+        response = self.middleware.process_response(self.request, response)
+        self.assertEqual(response.content, b'Cached')
+
+    def test_cache_miss(self):
+        response = self.middleware.process_response(
+            self.request, HttpResponse(HTML_CONTENT))
+        key = self.middleware.get_cache_key(
+            HTML_CONTENT.encode('utf-8'), ['world'], 'utf-8')
+        self.assertEqual(caches['default'].get(key),
+                         response.content)
+
+    def test_cache_too_large(self):
+        content = HTML_CONTENT * 100000
+        self.assertEqual(self.middleware.get_content_cache(content), None)
 
 
 class TestHighlightFilter(TestCase):
@@ -358,28 +1508,28 @@ class TestHighlightFilter(TestCase):
         <p>{{ content|highlight:"coding,fun" }}</p>
         """)
         html = t.render(context)
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
         t = Template("""
         {% load sekh_tags %}
         <p>{{ content|highlight:"coding, fun" }}</p>
         """)
         html = t.render(context)
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
         t = Template("""
         {% load sekh_tags %}
         <p>{{ content|highlight:"coding fun" }}</p>
         """)
         html = t.render(context)
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
         t = Template("""
         {% load sekh_tags %}
         <p>{{ content|highlight:"coding coding fun" }}</p>
         """)
         html = t.render(context)
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
     def test_filter_with_variable(self):
         t = Template("""
@@ -388,7 +1538,31 @@ class TestHighlightFilter(TestCase):
         """)
         html = t.render(Context({'content': 'Coding is fun :).',
                                  'query': 'coding, fun'}))
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
+
+    def test_filter_escaping(self):
+        t = Template("""
+        {% load sekh_tags %}
+        <p>{{ content|highlight:"amp coding" }}</p>
+        """)
+        html = t.render(Context({'content': '<Coding> & camping'}))
+        self.assertEqual(
+            html.strip(),
+            '<p>&lt;<span class="highlight term-2">Coding</span>&gt; '
+            '&amp; c<span class="highlight term-1">amp</span>ing</p>')
+
+    def test_filter_safe(self):
+        t = Template("""
+        {% load sekh_tags %}
+        <p>{{ content|safe|highlight:"coding,fun" }}</p>
+        """)
+        html = t.render(Context({'content': 'Coding is fun :).'}))
+        self.assertEqual(html.strip(), self.response)
+        html = t.render(Context({'content': '<b>Coding</b> is &lt;fun&gt;'}))
+        self.assertEqual(
+            html.strip(),
+            '<p><b><span class="highlight term-1">Coding</span></b> is '
+            '&lt;<span class="highlight term-2">fun</span>&gt;</p>')
 
 
 class TestHighlightTag(TestCase):
@@ -404,7 +1578,7 @@ class TestHighlightTag(TestCase):
         {% endhighlight %}
         """)
         html = t.render(Context({'content': 'Coding is fun :).'}))
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
         t = Template("""
         {% load sekh_tags %}
@@ -413,7 +1587,7 @@ class TestHighlightTag(TestCase):
         {% endhighlight %}
         """)
         html = t.render(Context())
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
         t = Template("""
         {% load sekh_tags %}
@@ -422,7 +1596,7 @@ class TestHighlightTag(TestCase):
         {% endhighlight %}
         """)
         html = t.render(Context())
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
         t = Template("""
         {% load sekh_tags %}
@@ -431,7 +1605,7 @@ class TestHighlightTag(TestCase):
         {% endhighlight %}
         """)
         html = t.render(Context())
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
         t = Template("""
         {% load sekh_tags %}
@@ -440,7 +1614,7 @@ class TestHighlightTag(TestCase):
         {% endhighlight %}
         """)
         html = t.render(Context())
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
     def test_tag_variable_content(self):
         t = Template("""
@@ -451,7 +1625,21 @@ class TestHighlightTag(TestCase):
         """)
         html = t.render(Context({'content': 'Coding is fun :).',
                                  'query': 'coding, fun'}))
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
+
+    def test_tag_in_loop(self):
+        t = Template("""
+        {% load sekh_tags %}
+        {% for query in queries %}{% highlight query %}
+        <p>{{ content }}</p>
+        {% endhighlight %}{% endfor %}
+        """)
+        html = t.render(Context({'content': 'Coding is fun :).',
+                                 'queries': ['coding, fun', 'fun',
+                                             'coding, fun']}))
+        self.assertEqual(html.split(), (
+            self.response + ' <p>Coding is <span class="highlight '
+            'term-1">fun</span> :).</p> ' + self.response).split())
 
     def test_tag_error(self):
         with self.assertRaises(TemplateSyntaxError):
@@ -500,28 +1688,28 @@ class TestExcerptFilter(ExcerptTestCase):
         {{ content|excerpt:"beautiful,temptation" }}
         """)
         html = t.render(context)
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
         t = Template("""
         {% load sekh_tags %}
         {{ content|excerpt:"beautiful, temptation" }}
         """)
         html = t.render(context)
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
         t = Template("""
         {% load sekh_tags %}
         {{ content|excerpt:"beautiful temptation" }}
         """)
         html = t.render(context)
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
         t = Template("""
         {% load sekh_tags %}
         {{ content|excerpt:"beautiful beautiful temptation" }}
         """)
         html = t.render(context)
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
     def test_filter_with_variable(self):
         t = Template("""
@@ -530,7 +1718,35 @@ class TestExcerptFilter(ExcerptTestCase):
         """)
         html = t.render(Context({'content': self.content,
                                  'query': 'beautiful, temptation'}))
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
+
+
+class TestExcerptHighlightFilter(ExcerptTestCase):
+    """Tests of Excerpt highlight filter"""
+
+    def test_filter(self):
+        context = Context({'content': self.content + ' <Beautiful>',
+                           'query': 'beautiful,temptation'})
+        t = Template("""
+        {% load sekh_tags %}
+        {{ content|excerpt_highlight:query }}
+        {{ content|excerpt:query|highlight:query }}
+        """)
+        html, chained = t.render(context).strip().splitlines()
+        html, chained = html.strip(), chained.strip()
+        self.assertEqual(html, chained)
+        self.assertTrue('class="highlight term-2">temptation<' in html)
+
+    def test_filter_autoescape_off(self):
+        t = Template("""
+        {% load sekh_tags %}{% autoescape off %}
+        {{ content|excerpt_highlight:"beautiful" }}
+        {% endautoescape %}
+        """)
+        html = t.render(Context({'content': '<b>Beautiful</b> code'}))
+        self.assertEqual(
+            html.strip(),
+            '<b><span class="highlight term-1">Beautiful</span></b> code')
 
 
 class TestExcerptTag(ExcerptTestCase):
@@ -545,7 +1761,7 @@ class TestExcerptTag(ExcerptTestCase):
         {% endexcerpt %}
         """)
         html = t.render(context)
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
         t = Template("""
         {% load sekh_tags %}
@@ -554,7 +1770,7 @@ class TestExcerptTag(ExcerptTestCase):
         {% endexcerpt %}
         """)
         html = t.render(context)
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
         t = Template("""
         {% load sekh_tags %}
@@ -563,7 +1779,7 @@ class TestExcerptTag(ExcerptTestCase):
         {% endexcerpt %}
         """)
         html = t.render(context)
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
         t = Template("""
         {%% load sekh_tags %%}
@@ -572,7 +1788,7 @@ class TestExcerptTag(ExcerptTestCase):
         {%% endexcerpt %%}
         """ % self.content)
         html = t.render(Context())
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
         t = Template("""
         {% load sekh_tags %}
@@ -581,7 +1797,7 @@ class TestExcerptTag(ExcerptTestCase):
         {% endexcerpt %}
         """)
         html = t.render(context)
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
         t = Template("""
         {% load sekh_tags %}
@@ -591,7 +1807,7 @@ class TestExcerptTag(ExcerptTestCase):
         """)
         html = t.render(context)
 
-        self.assertEquals(
+        self.assertEqual(
             html.strip(),
             'of Python, by Tim Peters Beautiful is better than ugly. '
             'Explicit ... temptation to guess. There should be')
@@ -605,7 +1821,7 @@ class TestExcerptTag(ExcerptTestCase):
         """)
         html = t.render(Context({'content': self.content,
                                  'query': 'beautiful, temptation'}))
-        self.assertEquals(html.strip(), self.response)
+        self.assertEqual(html.strip(), self.response)
 
     def test_tag_error(self):
         with self.assertRaises(TemplateSyntaxError):
@@ -615,3 +1831,34 @@ class TestExcerptTag(ExcerptTestCase):
             <p>Coding is fun :).</p>
             {% endexcerpt %}
             """)
+
+
+class TestExcerptManyTag(ExcerptTestCase):
+    """Test for Excerpt many tag"""
+
+    def test_tag(self):
+        context = Context({'documents': [self.content, 'Nothing']})
+        t = Template("""
+        {% load sekh_tags %}
+        {% excerpt_many documents "beautiful temptation" as excerpts %}
+        {% for document, excerpt in excerpts %}{{ excerpt }}|{% endfor %}
+        """)
+        html = t.render(context)
+        self.assertEqual(html.strip(), '%s|Nothing|' % self.response)
+
+    def test_tag_field(self):
+        context = Context({'documents': [{'text': self.content}],
+                           'terms': 'beautiful temptation'})
+        t = Template("""
+        {% load sekh_tags %}
+        {% excerpt_many documents terms 10 "text" as excerpts %}
+        {% for document, excerpt in excerpts %}{{ excerpt }}{% endfor %}
+        """)
+        html = t.render(context)
+        self.assertEqual(html.strip(), excerpt(
+            self.content, ['beautiful', 'temptation'], 10))
+
+    def test_tag_error(self):
+        self.assertRaises(TemplateSyntaxError, Template,
+                          '{% load sekh_tags %}'
+                          '{% excerpt_many documents "terms" %}')
@@ -1,10 +1,11 @@
 """Utils for django-sekh"""
-try:
-    from future_builtins import zip
-except ImportError:
-    pass
-
 import re
+from threading import Lock
+from collections import deque
+from collections import OrderedDict
+
+from sekh.settings import PATTERN_CACHE_SIZE
+from sekh.settings import AUTOMATON_THRESHOLD
 
 
 def remove_duplicates(items):
@@ -31,6 +32,360 @@ def compile_terms(terms):
             for term in terms]
 
 
+class TermsPattern(object):
+    """
+    Match all the terms at once with a single alternation,
+    each term being captured in its own group.
+    """
+
+    def __init__(self, terms):
+        self.terms = list(terms)
+        self.max_length = max([len(term) for term in self.terms] or [0])
+        self.regex = re.compile(
+            '|'.join('(%s)' % re.escape(term) for term in self.terms),
+            re.I | re.U)
+
+    def finditer(self, text):
+        """
+        Yields (start, end, index) for each non-overlapping
+        match in text, index being the position of the matched term.
+        """
+        if not self.terms:
+            return
+        for match in self.regex.finditer(text):
+            yield match.start(), match.end(), match.lastindex - 1
+
+    def search(self, text, position=0):
+        """
+        Returns the position of the first match
+        in text after position, or -1.
+        """
+        if not self.terms:
+            return -1
+        match = self.regex.search(text, position)
+        return match.start() if match else -1
+
+    def match(self, word):
+        """
+        Returns the index of the first term matching
+        the beginning of the word, or None.
+        """
+        if not self.terms:
+            return None
+        match = self.regex.match(word)
+        return match.lastindex - 1 if match else None
+
+
+# Non ASCII characters matching an ASCII letter case-insensitively
+ASCII_FOLDS = {'i': '\u0130\u0131', 'k': '\u212a', 's': '\u017f'}
+
+
+def build_case_folds():
+    """
+    Returns the table folding each lowercase character matching
+    other ones with re.I, like the sigmas, to the first one
+    of its equivalence class, as translate takes it.
+    """
+    try:
+        from re._casefix import _EXTRA_CASES
+        classes = [(code,) + codes for code, codes in _EXTRA_CASES.items()]
+    except ImportError:  # Python < 3.11
+        from sre_compile import _equivalences as classes
+    folds = dict((code, chr(min(codes)))
+                 for codes in classes for code in codes)
+    # The only character lowercased in two characters
+    # is lowercased by re.I in its first one
+    folds[0x130] = folds.get(0x69, 'i')
+    return folds
+
+
+CASE_FOLDS = build_case_folds()
+
+
+def fold_case(text):
+    """
+    Lowercase a text, character per character,
+    to keep the positions of the original text,
+    folding the characters as re.I does.
+    """
+    folded = text.lower()
+    if len(folded) != len(text):
+        folded = ''.join(len(char.lower()) == 1 and char.lower() or char
+                         for char in text)
+    return folded.translate(CASE_FOLDS)
+
+
+class TermsAutomaton(object):
+    """
+    Aho-Corasick automaton matching all the terms
+    at once in a linear scan, for large sets of terms.
+    Matches the same way as TermsPattern.
+    """
+
+    def __init__(self, terms):
+        self.terms = list(terms)
+        self.max_length = max([len(term) for term in self.terms] or [0])
+        self.goto = [{}]
+        self.outputs = [[]]
+
+        for index, term in enumerate(self.terms):
+            state = 0
+            for char in fold_case(term):
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.outputs.append([])
+                state = next_state
+            if term:
+                self.outputs[state].append((len(term), index))
+
+        self.fail = [0] * len(self.goto)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[next_state] = fail
+                self.outputs[next_state].extend(self.outputs[fail])
+
+    def iterhits(self, text, end=None):
+        """
+        Yields (start, end, index) for every hit of a term in text,
+        overlapping or not, ordered by end position.
+        """
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        state = 0
+        for position, char in enumerate(fold_case(text[:end])):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, index in outputs[state]:
+                yield position + 1 - length, position + 1, index
+
+    def finditer(self, text):
+        """
+        Yields (start, end, index) for each non-overlapping
+        match in text, index being the position of the matched term.
+        The leftmost hits are preferred, then the first terms.
+        """
+        position = 0
+        for start, end, index in sorted(
+                self.iterhits(text), key=lambda hit: (hit[0], hit[2])):
+            if start >= position:
+                position = end
+                yield start, end, index
+
+    def search(self, text, position=0):
+        """
+        Returns the start of the first term found
+        in text after position, or -1, the scan going on
+        until no term ending later can start before.
+        """
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        state = 0
+        first = -1
+        for position in range(position, len(text)):
+            if first != -1 and position + 1 - self.max_length >= first:
+                break
+            char = fold_case(text[position])
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if outputs[state]:
+                start = position + 1 - max(outputs[state])[0]
+                if first == -1 or start < first:
+                    first = start
+        return first
+
+    def match(self, word):
+        """
+        Returns the index of the first term matching
+        the beginning of the word, or None.
+        """
+        indexes = [index for start, end, index in
+                   self.iterhits(word, self.max_length) if not start]
+        return min(indexes) if indexes else None
+
+
+def compile_pattern(terms):
+    """
+    Compile terms for matching them in one pass,
+    with an automaton if there is a lot of terms.
+    """
+    if len(terms) > AUTOMATON_THRESHOLD:
+        return TermsAutomaton(terms)
+    return TermsPattern(terms)
+
+
+class LRUCache(object):
+    """
+    Thread-safe bounded cache, discarding
+    the least recently used items first.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            if not self.max_size:
+                return
+            self.data[key] = value
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        """
+        Returns the statistics of the cache.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.data), 'max_size': self.max_size}
+
+
+patterns_cache = LRUCache(PATTERN_CACHE_SIZE)
+
+
+def get_pattern(terms):
+    """
+    Returns the compiled pattern of the terms, without
+    duplicates, from the cache of the process if possible.
+    """
+    terms = tuple(remove_duplicates(terms))
+    pattern = patterns_cache.get(terms)
+    if pattern is None:
+        pattern = compile_pattern(terms)
+        patterns_cache.set(terms, pattern)
+    return pattern
+
+
+class DomainTrie(object):
+    """
+    Index of domains by their reversed labels, a domain being found
+    under any subdomain and followed by any top level domain made
+    of one or two labels of two or three letters.
+    """
+    top_level_re = re.compile(r'^[a-z]{2,3}$')
+    subdomain_re = re.compile(r'^[-.a-z\d]+$')
+
+    def __init__(self, domains=()):
+        self.root = {}
+        for domain, value in domains:
+            self.add(domain, value)
+
+    def add(self, domain, value):
+        node = self.root
+        for label in reversed(domain.lower().split('.')):
+            node = node.setdefault(label, {})
+        node[None] = value
+
+    def lookup(self, host):
+        """
+        Returns the value of the longest domain found in host,
+        the shortest top level domain being tried first, or None.
+        """
+        labels = host.lower().split('.')
+        for top_level in (1, 2):
+            if (len(labels) <= top_level or
+                    not self.top_level_re.match(labels[-top_level])):
+                return None
+            node = self.root
+            value = None
+            position = len(labels) - top_level
+            while position and labels[position - 1] in node:
+                position -= 1
+                node = node[labels[position]]
+                if None in node and (not position or self.subdomain_re.match(
+                        '.'.join(labels[:position]))):
+                    value = node[None]
+            if value is not None:
+                return value
+        return None
+
+
+ASCII_PROBE = ''.join(chr(i) for i in range(128))
+
+
+def compile_prefilter(terms, charset=None):
+    """
+    Compile terms as a single regular expression finding
+    any of them case-insensitively, in a text or in a content
+    encoded with charset if the terms are ASCII.
+    """
+    if charset is None:
+        return re.compile('|'.join(re.escape(term) for term in terms),
+                          re.I | re.U)
+
+    alternatives = []
+    for term in terms:
+        chars = []
+        for char in term:
+            variants = []
+            for variant in char + ASCII_FOLDS.get(char.lower(), ''):
+                try:
+                    variants.append(re.escape(variant.encode(charset)))
+                except UnicodeEncodeError:
+                    pass
+            chars.append(len(variants) > 1 and
+                         b'(?:' + b'|'.join(variants) + b')' or variants[0])
+        alternatives.append(b''.join(chars))
+    return re.compile(b'|'.join(alternatives), re.I)
+
+
+def get_prefilter(terms, charset=None):
+    """
+    Returns the compiled prefilter of the terms, or None
+    if the content encoded with charset cannot be searched
+    without being decoded.
+    """
+    terms = tuple(remove_duplicates(terms))
+    if charset is not None:
+        charset = charset.lower()
+        if not all(ord(char) < 128 for term in terms for char in term):
+            return None
+        if (ASCII_PROBE.encode(charset, 'ignore') !=
+                ASCII_PROBE.encode('ascii')):
+            return None
+
+    key = (terms, charset)
+    prefilter = patterns_cache.get(key)
+    if prefilter is None:
+        prefilter = compile_prefilter(terms, charset)
+        patterns_cache.set(key, prefilter)
+    return prefilter
+
+
 def list_range(x):
     """
     Returns the range of a list.
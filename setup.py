@@ -16,13 +16,19 @@ setup(
     author_email=sekh.__email__,
     url=sekh.__url__,
 
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     classifiers=[
         'Framework :: Django',
         'Development Status :: 5 - Production/Stable',
         'Environment :: Web Environment',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
+        'Framework :: Django :: 4.2',
         'Intended Audience :: Developers',
         'Operating System :: OS Independent',
         'License :: OSI Approved :: BSD License',
@@ -31,5 +37,8 @@ setup(
     license=sekh.__license__,
     include_package_data=True,
     zip_safe=False,
-    install_requires=['beautifulsoup4']
+    python_requires='>=3.9',
+    install_requires=['Django>=4.2', 'asgiref>=3.6'],
+    extras_require={'lxml': ['lxml'], 'numpy': ['numpy'],
+                    'brotli': ['brotli>=1.2']}
     )